@@ -1,5 +1,7 @@
 import numpy as np
 
+from mapper import best_mapping, conv_loop_bounds, default_mapping, print_mapping, tile_loop_nest
+
 def quantize_activations(activations, quantization_threshold=0.5):
     quantized_activations = []
     overflow_flags = []
@@ -26,7 +28,7 @@ def multiplier_group(quantized_activations, weights, overflow_flags, m, int_max_
                 result += (int_max_value if quantized_activations[i] > 0 else int_min_value) * weights[i]
     return result
 
-def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantization_threshold=0.5, m=1, iterations_per_tile=2):
+def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantization_threshold=0.5, m=1, iterations_per_tile=2, mapping=None):
     N, Hout, Wout, Cin = input_activations.shape
     Cout, Kh, Kw, Cin_weight = weight_vector.shape
 
@@ -35,6 +37,13 @@ def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantizatio
 
     output = np.zeros((Hout, Wout, Cout))
 
+    # The multiplier group reduces the whole flattened tile, so only the d1/d2
+    # loop order and tile sizes of the mapping apply here (d1 outer by default)
+    bounds = conv_loop_bounds(N, Hout, Wout, Cin, Cout, Kh, Kw)
+    if mapping is None:
+        mapping = default_mapping(bounds, 1, 1)
+    nest = {"loop_order": tuple(dim for dim in mapping["loop_order"] if dim != "d3"), "tiles": mapping["tiles"]}
+
     # Memory access and iteration counters
     activation_memory_accesses = 0
     weight_memory_accesses = 0
@@ -44,31 +53,39 @@ def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantizatio
     total_multiplier_operations = 0
     total_tile_iterations = 0
 
-    for d1 in range(N * Hout * Wout):
-        total_main_iterations += 1
-        batch_idx = d1 // (Hout * Wout)
-        spatial_idx = d1 % (Hout * Wout)
-        out_h = spatial_idx // Wout
-        out_w = spatial_idx % Wout
-        
-        input_tile = input_activations[batch_idx, out_h:out_h+Kh, out_w:out_w+Kw, :]
-        activation_memory_accesses += 1
+    loaded_d1 = loaded_d2 = None
+    for tile in tile_loop_nest(nest, bounds):
+        # Input and weight tiles stay on chip until the loop that indexes them moves on
+        if tile["d1"] != loaded_d1:
+            loaded_d1 = tile["d1"]
+            activation_memory_accesses += len(range(N * Hout * Wout)[loaded_d1])
+            total_main_iterations += len(range(N * Hout * Wout)[loaded_d1])
+        if tile["d2"] != loaded_d2:
+            loaded_d2 = tile["d2"]
+            weight_memory_accesses += len(range(Cout)[loaded_d2])
+
+        for d1 in range(tile["d1"].start, tile["d1"].stop):
+            batch_idx = d1 // (Hout * Wout)
+            spatial_idx = d1 % (Hout * Wout)
+            out_h = spatial_idx // Wout
+            out_w = spatial_idx % Wout
+
+            input_tile = input_activations[batch_idx, out_h:out_h+Kh, out_w:out_w+Kw, :]
 
-        for d2 in range(Cout):
-            total_output_channel_iterations += 1
-            weights_for_d2 = weight_vector[d2, :, :, :]
-            weight_memory_accesses += 1
+            for d2 in range(tile["d2"].start, tile["d2"].stop):
+                total_output_channel_iterations += 1
+                weights_for_d2 = weight_vector[d2, :, :, :]
 
-            flattened_input = input_tile.flatten()
-            flattened_weights = weights_for_d2.flatten()
+                flattened_input = input_tile.flatten()
+                flattened_weights = weights_for_d2.flatten()
 
-            quantized_activations, overflow_flags = quantize_activations(flattened_input, quantization_threshold)
-            total_quantization_operations += len(flattened_input)
+                quantized_activations, overflow_flags = quantize_activations(flattened_input, quantization_threshold)
+                total_quantization_operations += len(flattened_input)
 
-            for _ in range(iterations_per_tile):
-                total_tile_iterations += 1
-                total_multiplier_operations += len(flattened_input)
-                result = multiplier_group(quantized_activations, flattened_weights, overflow_flags, m)
+                for _ in range(iterations_per_tile):
+                    total_tile_iterations += 1
+                    total_multiplier_operations += len(flattened_input)
+                    result = multiplier_group(quantized_activations, flattened_weights, overflow_flags, m)
 
     # Print iteration and memory access counts
     print(f"Total main iterations (over spatial locations): {total_main_iterations}")
@@ -81,12 +98,15 @@ def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantizatio
 
     return output
 
-# Example usage
-N, Hout, Wout, Cin = 1, 128, 128, 3
-Kh, Kw = 3, 3
-Cout = 64
-input_activations = np.random.rand(N, Hout + Kh - 1, Wout + Kw - 1, Cin)  # Extended dimensions for valid convolution
-weight_vector = np.random.rand(Cout, Kh, Kw, Cin)
-quantization_threshold = 0.5
-m = 1
-output = compute_conv2d_pe(input_activations, weight_vector, (Kh, Kw), quantization_threshold, m)
+if __name__ == "__main__":
+    # Example usage
+    N, Hout, Wout, Cin = 1, 128, 128, 3
+    Kh, Kw = 3, 3
+    Cout = 64
+    input_activations = np.random.rand(N, Hout + Kh - 1, Wout + Kw - 1, Cin)  # Extended dimensions for valid convolution
+    weight_vector = np.random.rand(Cout, Kh, Kw, Cin)
+    quantization_threshold = 0.5
+    m = 1
+    mapping = best_mapping(conv_loop_bounds(*input_activations.shape, Cout, Kh, Kw))
+    print_mapping(mapping)
+    output = compute_conv2d_pe(input_activations, weight_vector, (Kh, Kw), quantization_threshold, m, mapping=mapping)
@@ -1,7 +1,10 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from mapper import best_mapping, conv_loop_bounds, default_mapping, print_mapping, tile_loop_nest
 
 class CambriconDSimulator:
-    def __init__(self, N, Hout, Wout, Cin, Cout, Kh, Kw, m, n, clock_speed, memory_bandwidth):
+    def __init__(self, N, Hout, Wout, Cin, Cout, Kh, Kw, m, n, clock_speed, memory_bandwidth, requant_shift=8):
         # Architecture parameters
         self.N = N  # Batch size
         self.Hout = Hout  # Output height
@@ -14,6 +17,7 @@ class CambriconDSimulator:
         self.n = n  # Number of int3-and-fp16 multipliers for inliers
         self.clock_speed = clock_speed  # Clock speed (Hz)
         self.memory_bandwidth = memory_bandwidth  # Memory bandwidth (bytes per second)
+        self.requant_shift = requant_shift  # Right shift requantizing the int32 psums to 8-bit activations
         
         # PE array size (128x128)
         self.PE_rows = 128
@@ -22,81 +26,144 @@ class CambriconDSimulator:
         
         # Initialize buffers with random values for simulation
         self.InputBuf = np.random.randint(0, 256, (N, Hout, Wout, Cin), dtype=np.uint8)
-        self.WeightBuf = np.random.randint(0, 256, (Kh, Kw, Cin, Cout), dtype=np.uint8)
-        self.OutputBuf = np.zeros((N, Hout, Wout, Cout), dtype=np.uint16)
+        self.WeightBuf = np.random.randint(-128, 128, (Kh, Kw, Cin, Cout), dtype=np.int8)
+        self.OutputBuf = np.zeros((N, Hout, Wout, Cout), dtype=np.int32)  # Signed psums, accumulated over d3
+        self.ActivationBuf = np.zeros((N, Hout, Wout, Cout), dtype=np.uint8)  # Requantized SFU outputs
+        self.SignMask = np.zeros((N, Hout, Wout, Cout), dtype=bool)  # Sign bits for the next timestep's ReLU
         
         # Initialize cycle counters and memory accesses
         self.total_cycles = 0
         self.memory_accesses = 0
+        self.pe_cycles = np.zeros((self.PE_rows, self.PE_cols), dtype=np.int64)  # Busy cycles of each PE
+        self.sfu_stats = {
+            "tiles": 0,  # Output tiles through the epilogue
+            "elements": 0,
+            "max_tile_elements": 0,  # Widest tile the SFU has to take at once
+            "fused_dram_write_bytes": 0,
+            "unfused_dram_write_bytes": 0,
+            "unfused_dram_read_bytes": 0,
+        }
     
     def quantize_input(self, input_val):
-        """Quantizes input values (simulating fp to int conversion)."""
+        """Quantizes input values (simulating fp to int conversion), elementwise over a whole tile."""
         int_val = np.clip(input_val, 0, 255)  # Example: scale to 8-bit range
-        overflow_flag = 1 if input_val > 255 else 0
+        overflow_flag = input_val > 255
         return int_val, overflow_flag
     
     def handle_outliers(self, input_val, overflow_flag):
         """Handles outliers using fp16 multipliers if quantization fails."""
-        if overflow_flag:
-            return float(input_val)  # Treat as fp16 for outliers
-        return input_val  # Inliers are returned as integer
+        return np.where(overflow_flag, input_val.astype(np.float64), input_val)  # Outliers as fp16, inliers as integer
     
     def compute_dot_product(self, input_tile, weight_tile):
         """Computes the dot product of input and weight tiles."""
         return np.sum(input_tile * weight_tile)
 
     def compute_tile(self, Tilein, Tilew):
-        """Simulates the computation of a tile."""
+        """
+        Simulates the computation of a tile on the whole PE array at once.
+        PE (i, j) reduces input row i of Tilein with weight row j of Tilew.
+        Returns the partial sums of all PEs and the cycles each PE takes: its
+        n int multipliers handle the inliers and its m fp multipliers the outliers,
+        both in parallel.
+        """
         # Step 1: Quantize the input values
         int_input, overflow_flag = self.quantize_input(Tilein)
         
         # Step 2: Handle inliers and outliers separately
-        dot_product = 0
-        for i in range(len(int_input)):
-            dot_product += self.handle_outliers(int_input[i], overflow_flag[i]) * Tilew[i]
-        
-        return dot_product
-
-    def compute_conv2d(self):
-        """Performs the convolution operation."""
-        for d1 in range(self.N * self.Hout * self.Wout // self.PE_rows):
-            for d2 in range(self.Cout // self.PE_cols):
-                for d3 in range(self.Kh * self.Kw * self.Cin // self.PE_cols):
-                    
-                    # Step 2: Read tiles from InputBuf and WeightBuf
-                    Tilein = self.InputBuf[d1:d1+self.PE_rows, d3:d3+self.PE_cols]
-                    Tilew = self.WeightBuf[d2:d2+self.PE_cols, d3:d3+self.PE_cols]
-                    
-                    # Initialize output tile (zeros initially)
-                    Tileout = np.zeros_like(Tilein, dtype=np.uint16)
-                    
-                    # Step 3: Perform iterations per tile (multiple iterations per tile)
-                    for _ in range(self.total_PEs):
-                        Tilepartial = self.compute_tile(Tilein, Tilew)
-                        Tileout += Tilepartial
-                    
-                    # Step 4: Write output tile to OutputBuf
-                    self.OutputBuf[d1, d2] = Tileout
-                    
-                    # Step 5: ReLU activation (SFU activation)
-                    self.OutputBuf = np.maximum(0, self.OutputBuf)  # ReLU activation
-                    
-                    # Count memory accesses
-                    self.memory_accesses += (self.PE_rows * self.PE_cols)  # Input memory accesses
-                    self.memory_accesses += (self.PE_cols * self.PE_cols)  # Weight memory accesses
-                    self.memory_accesses += (self.PE_rows * self.PE_cols)  # Output memory accesses
-
-                    # Estimate cycles for memory access and computation:
-                    # Each read/write operation takes some cycles (simplified)
-                    # Memory accesses: Reading InputBuf, WeightBuf, and Writing OutputBuf
-                    memory_access_cycles = (self.PE_rows * self.PE_cols * 2)  # Read input and weight
-                    memory_access_cycles += (self.PE_rows * self.PE_cols)  # Write to OutputBuf
-                    
-                    # Each computation involves dot product calculation (for simplicity, count as 1 cycle)
-                    computation_cycles = self.PE_cols * self.PE_cols  # One cycle per operation
-                    
-                    # Add memory and computation cycles
-                    self.total_cycles += memory_access_cycles + computation_cycles
+        operands = self.handle_outliers(int_input, overflow_flag).astype(np.float64)
+        Tilepartial = operands @ Tilew.T.astype(np.float64)
+
+        # Every PE of a row sees the same inputs, so the cycles only depend on the row
+        outliers = overflow_flag.sum(axis=1)
+        inliers = Tilein.shape[1] - outliers
+        row_cycles = np.maximum(-(-inliers // self.n), -(-outliers // self.m))
+        pe_cycles = np.broadcast_to(row_cycles[:, None], Tilepartial.shape)
+        return Tilepartial, pe_cycles
+
+    def sfu_epilogue(self, d1, d2):
+        """
+        SFU stage run once per finished output tile while it is still on chip:
+        ReLU, requantization to 8 bits and the sign mask. Only the activations
+        and the bit-packed sign mask go to DRAM. Unfused, the int32 psums would
+        be written to DRAM and read back by a separate SFU pass before the same
+        activations and sign mask are written; the stats count both.
+        """
+        Tileout = self.OutputBuf.reshape(-1, self.Cout)[d1, d2]
+        activated = np.maximum(0, Tileout)  # ReLU activation
+        self.ActivationBuf.reshape(-1, self.Cout)[d1, d2] = np.minimum(activated >> self.requant_shift, 255)
+        self.SignMask.reshape(-1, self.Cout)[d1, d2] = activated > 0
+
+        elements = Tileout.size
+        activation_bytes = elements * self.ActivationBuf.itemsize
+        sign_mask_bytes = -(-elements // 8)
+        output_bytes = elements * self.OutputBuf.itemsize
+        self.sfu_stats["tiles"] += 1
+        self.sfu_stats["elements"] += elements
+        self.sfu_stats["max_tile_elements"] = max(self.sfu_stats["max_tile_elements"], elements)
+        self.sfu_stats["fused_dram_write_bytes"] += activation_bytes + sign_mask_bytes
+        self.sfu_stats["unfused_dram_write_bytes"] += output_bytes + activation_bytes + sign_mask_bytes
+        self.sfu_stats["unfused_dram_read_bytes"] += output_bytes
+
+    def dram_write_bytes_saved(self):
+        """DRAM bytes written by an unfused SFU pass that the fused epilogue avoids."""
+        return self.sfu_stats["unfused_dram_write_bytes"] - self.sfu_stats["fused_dram_write_bytes"]
+
+    def loop_bounds(self):
+        """Trip counts of the d1 (spatial), d2 (output channel) and d3 (reduction) loops."""
+        return conv_loop_bounds(self.N, self.Hout, self.Wout, self.Cin, self.Cout, self.Kh, self.Kw)
+
+    def im2col(self):
+        """Lays InputBuf out as a (N*Hout*Wout) x (Kh*Kw*Cin) matrix, zero-padding the bottom/right edges."""
+        padded = np.pad(self.InputBuf, ((0, 0), (0, self.Kh - 1), (0, self.Kw - 1), (0, 0)))
+        windows = sliding_window_view(padded, (self.Kh, self.Kw), axis=(1, 2))  # (N, Hout, Wout, Cin, Kh, Kw)
+        return windows.transpose(0, 1, 2, 4, 5, 3).reshape(self.N * self.Hout * self.Wout, -1)
+
+    def compute_conv2d(self, mapping=None):
+        """Performs the convolution operation with the loop order and tile sizes of a mapping (see mapper.py)."""
+        bounds = self.loop_bounds()
+        if mapping is None:
+            mapping = default_mapping(bounds, self.PE_rows, self.PE_cols)
+        if mapping["tiles"]["d1"] > self.PE_rows or mapping["tiles"]["d2"] > self.PE_cols:
+            raise ValueError(f"Tiles {mapping['tiles']} do not fit the {self.PE_rows}x{self.PE_cols} PE array.")
+
+        InputMatrix = self.im2col()  # d1 x d3
+        WeightMatrix = self.WeightBuf.reshape(-1, self.Cout).T  # d2 x d3
+
+        for tile in tile_loop_nest(mapping, bounds):
+            d1, d2, d3 = tile["d1"], tile["d2"], tile["d3"]
+
+            # Step 2: Read tiles from InputBuf and WeightBuf
+            Tilein = InputMatrix[d1, d3]
+            Tilew = WeightMatrix[d2, d3]
+
+            # Step 3: Compute the partial sums of all PEs
+            Tilepartial, pe_cycles = self.compute_tile(Tilein, Tilew)
+            Tileout = np.rint(Tilepartial).astype(np.int32)
+            self.pe_cycles[:pe_cycles.shape[0], :pe_cycles.shape[1]] += pe_cycles
+
+            # Step 4: Accumulate the output tile into OutputBuf (partial sums over d3)
+            self.OutputBuf.reshape(-1, self.Cout)[d1, d2] += Tileout
+
+            # Step 5: SFU epilogue once the last d3 tile has been accumulated
+            if d3.stop == bounds["d3"]:
+                self.sfu_epilogue(d1, d2)
+
+            # Count memory accesses
+            self.memory_accesses += Tilein.size  # Input memory accesses
+            self.memory_accesses += Tilew.size  # Weight memory accesses
+            self.memory_accesses += Tileout.size  # Output memory accesses
+
+            # Estimate cycles for memory access and computation:
+            # Each read/write operation takes some cycles (simplified)
+            # Memory accesses: Reading InputBuf, WeightBuf, and Writing OutputBuf
+            memory_access_cycles = Tilein.size + Tilew.size  # Read input and weight
+            memory_access_cycles += Tileout.size  # Write to OutputBuf
+
+            # The tile is done when its slowest PE is
+            computation_cycles = int(pe_cycles.max())
+
+            # Add memory and computation cycles
+            self.total_cycles += memory_access_cycles + computation_cycles
 
     def get_total_cycles(self):
         return self.total_cycles
@@ -104,16 +171,32 @@ class CambriconDSimulator:
     def get_memory_accesses(self):
         return self.memory_accesses
 
+    def get_pe_utilization(self):
+        """Busy cycles of each PE as a fraction of the compute cycles of the run."""
+        compute_cycles = self.pe_cycles.max()
+        return self.pe_cycles / compute_cycles if compute_cycles else self.pe_cycles.astype(np.float64)
+
+
+if __name__ == "__main__":
+    # Initialize the simulation
+    simulator = CambriconDSimulator(
+        N=32, Hout=64, Wout=64, Cin=3, Cout=64, Kh=3, Kw=3, 
+        m=60, n=4, clock_speed=1e9, memory_bandwidth=1.5e12
+    )
 
-# Initialize the simulation
-simulator = CambriconDSimulator(
-    N=32, Hout=64, Wout=64, Cin=3, Cout=64, Kh=3, Kw=3, 
-    m=60, n=4, clock_speed=1e9, memory_bandwidth=1.5e12
-)
+    # Pick the loop order and tile sizes for this layer
+    mapping = best_mapping(simulator.loop_bounds(), PE_rows=simulator.PE_rows, PE_cols=simulator.PE_cols,
+                           macs_per_pe=simulator.n,
+                           bytes_per_cycle=simulator.memory_bandwidth / simulator.clock_speed)
+    print_mapping(mapping)
 
-# Run the convolution simulation
-simulator.compute_conv2d()
+    # Run the convolution simulation
+    simulator.compute_conv2d(mapping)
 
-# Output the simulation results
-print(f"Total Cycles: {simulator.get_total_cycles()}")
-print(f"Total Memory Accesses: {simulator.get_memory_accesses()}")
\ No newline at end of file
+    # Output the simulation results
+    print(f"Total Cycles: {simulator.get_total_cycles()}")
+    print(f"Total Memory Accesses: {simulator.get_memory_accesses()}")
+    print(f"Mean PE Utilization: {simulator.get_pe_utilization().mean():.3f}")
+    print(f"SFU Epilogue: {simulator.sfu_stats['tiles']} tiles (up to {simulator.sfu_stats['max_tile_elements']} elements), "
+          f"{simulator.dram_write_bytes_saved()} DRAM write bytes saved "
+          f"({simulator.sfu_stats['fused_dram_write_bytes']} fused vs {simulator.sfu_stats['unfused_dram_write_bytes']} unfused)")
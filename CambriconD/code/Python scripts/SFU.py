@@ -1,83 +1,189 @@
+import time
 import numpy as np
 
 # Define constants
 INT_MAX = 2147483647  # Define INT_MAX for 32-bit integer
 INT_MIN = -2147483648  # Define INT_MIN for 32-bit integer
 INPUT_SIZE = 128
-
-# Inputs
-sign_bits = np.random.choice([0, 1], INPUT_SIZE)  # Random 0/1 values for sign bits
-delta_input = np.random.uniform(-10, 10, INPUT_SIZE)  # Random real values for delta_input
-quantized_inliers = np.random.randint(INT_MIN, INT_MAX, INPUT_SIZE)  # Random integer inliers
-outlier_bitmap = np.random.choice([0, 1], INPUT_SIZE)  # Random 0/1 values for outlier_bitmap
-
-# Outputs
-updated_values = np.zeros(INPUT_SIZE)  # To store the final results
-overflow_flags = np.zeros(INPUT_SIZE, dtype=bool)  # Flags for overflow
-
-# Internal variables
-decompressed_inliers = np.zeros(INPUT_SIZE)  # Stores decompressed inliers
-decompressed_outliers = np.zeros(INPUT_SIZE)  # Stores decompressed outliers
-relu_output = np.zeros(INPUT_SIZE)  # Stores ReLU output
+SFU_CHUNK_SIZE = 65536  # Elements per chunk of the streaming SFU pipeline (multiple of 8)
 
 
 def int2fp_conversion(quantized_in, overflow_flags):
     """
     Converts integer quantized values to floating-point values.
     """
-    decompressed_out = np.zeros(INPUT_SIZE)
-    for i in range(INPUT_SIZE):
-        if quantized_in[i] == INT_MIN:
-            decompressed_out[i] = 0.0  # Map INT_MIN to 0
-            overflow_flags[i] = True
-        else:
-            decompressed_out[i] = float(quantized_in[i])  # Convert to floating-point
-            overflow_flags[i] = False
-    return decompressed_out
+    quantized_in = np.asarray(quantized_in)
+    overflow_flags[:] = quantized_in == INT_MIN  # INT_MIN marks an overflowed inlier
+    return np.where(overflow_flags, 0.0, quantized_in.astype(np.float64))  # Map INT_MIN to 0
 
 
 def decompress_outliers(bitmap, delta_in):
     """
     Decompress outliers using the bitmap and delta input.
     """
-    outlier_out = np.zeros(INPUT_SIZE)
-    for i in range(INPUT_SIZE):
-        if bitmap[i]:
-            outlier_out[i] = delta_in[i]
-        else:
-            outlier_out[i] = 0.0
-    return outlier_out
+    return np.where(np.asarray(bitmap, dtype=bool), delta_in, 0.0)
+
+
+def compress_outliers(bitmap, delta_in):
+    """
+    Encodes the outliers of a whole tensor as a compact (index, value) stream:
+    the flat positions of the set bitmap entries and the outlier values there.
+    """
+    indices = np.flatnonzero(bitmap)
+    values = np.ravel(delta_in)[indices]
+    return indices, values
+
+
+def decompress_outlier_stream(indices, values, shape):
+    """
+    Scatters an (index, value) outlier stream back into a dense tensor of the given shape.
+    """
+    outlier_out = np.zeros(int(np.prod(shape)))
+    outlier_out[indices] = values
+    return outlier_out.reshape(shape)
+
+
+def outlier_stream_bytes(num_outliers, num_elements, value_bits=16):
+    """
+    Size of the compressed outlier stream versus a dense outlier array. Each outlier
+    costs an index of ceil(log2(num_elements)) bits plus a value of value_bits.
+    Returns (stream_bytes, dense_bytes).
+    """
+    index_bits = max(1, int(np.ceil(np.log2(num_elements))))
+    stream_bytes = (num_outliers * (index_bits + value_bits) + 7) // 8
+    dense_bytes = num_elements * value_bits // 8
+    return stream_bytes, dense_bytes
 
 
 def relu_func(sign_bits, delta_in):
     """
     Applies the ReLU function to delta_input using sign_bits.
     """
-    relu_out = np.zeros(INPUT_SIZE)
-    for i in range(INPUT_SIZE):
-        if sign_bits[i]:
-            relu_out[i] = delta_in[i]  # Keep the value
-        else:
-            relu_out[i] = 0.0  # Set to 0
-    return relu_out
+    # Keep the value where the sign bit is set, 0 elsewhere
+    return np.where(np.asarray(sign_bits, dtype=bool), delta_in, 0.0)
 
 
-# Main execution
-# Step 1: Convert integers to floating-point
-decompressed_inliers = int2fp_conversion(quantized_inliers, overflow_flags)
+def pack_sign_bits(prev_output):
+    """
+    Stores the sign mask of the previous timestep's output as a bit-packed array
+    (1 bit per activation, set where the activation is positive).
+    """
+    return np.packbits(np.asarray(prev_output) > 0, axis=None)
 
-# Step 2: Decompress outliers
-decompressed_outliers = decompress_outliers(outlier_bitmap, delta_input)
 
-# Step 3: Apply the ReLU function
-relu_output = relu_func(sign_bits, delta_input)
+def relu_on_delta(packed_sign_bits, delta_in):
+    """
+    Applies ReLU-on-delta to a whole feature map: delta_Y' = delta_Y * sgn(Y_prev),
+    with the signs read from a bit-packed sign mask.
+    """
+    delta_in = np.asarray(delta_in)
+    # Unpack straight into a boolean mask (1 byte per activation, no wider copies)
+    sign_mask = np.unpackbits(packed_sign_bits, count=delta_in.size).view(bool)
+    return np.where(sign_mask.reshape(delta_in.shape), delta_in, 0.0)
+
+
+def sign_mask_storage(num_activations, activation_bits=16):
+    """
+    On-chip storage of the sign mask versus keeping the full-precision activations
+    of the previous timestep. Returns (sign_mask_bytes, full_precision_bytes, bytes_saved).
+    """
+    sign_mask_bytes = (num_activations + 7) // 8
+    full_precision_bytes = num_activations * activation_bits // 8
+    return sign_mask_bytes, full_precision_bytes, full_precision_bytes - sign_mask_bytes
+
+
+def sfu_pipeline(quantized_in, delta_in, outlier_indices, outlier_values, packed_sign_bits, chunk_size=SFU_CHUNK_SIZE):
+    """
+    Streams a whole feature map through the fused SFU stages (int2fp conversion,
+    outlier decompression and ReLU-on-delta) in chunks of chunk_size elements.
+    Outliers come as a sorted (index, value) stream and the signs as a bit-packed
+    mask. Returns (updated_values, overflow_flags, stats), where stats holds the
+    number of elements and chunks, the elapsed time and the elements per second.
+    """
+    if chunk_size % 8:
+        raise ValueError(f"Chunk size ({chunk_size}) must be a multiple of 8 to split the packed sign mask.")
 
-# Combine outputs (if necessary)
-updated_values = decompressed_inliers + decompressed_outliers + relu_output
+    delta_in = np.asarray(delta_in)
+    quantized_flat = np.ravel(quantized_in)
+    delta_flat = delta_in.ravel()
+    num_elements = delta_flat.size
 
-# Display results
-print("Decompressed Inliers:", decompressed_inliers)
-print("Decompressed Outliers:", decompressed_outliers)
-print("ReLU Output:", relu_output)
-print("Updated Values:", updated_values)
-print("Overflow Flags:", overflow_flags)
\ No newline at end of file
+    updated_values = np.empty(num_elements)
+    overflow_flags = np.empty(num_elements, dtype=bool)
+
+    start_time = time.perf_counter()
+    for start in range(0, num_elements, chunk_size):
+        stop = min(start + chunk_size, num_elements)
+
+        # Stage 1: int2fp conversion of the inliers
+        inliers = int2fp_conversion(quantized_flat[start:stop], overflow_flags[start:stop])
+
+        # Stage 2: scatter this chunk's part of the (index, value) outlier stream
+        lo, hi = np.searchsorted(outlier_indices, (start, stop))
+        outliers = np.zeros(stop - start)
+        outliers[outlier_indices[lo:hi] - start] = outlier_values[lo:hi]
+
+        # Stage 3: ReLU-on-delta with this chunk's slice of the packed sign mask
+        relu_out = relu_on_delta(packed_sign_bits[start // 8:(stop + 7) // 8], delta_flat[start:stop])
+
+        updated_values[start:stop] = inliers + outliers + relu_out
+    elapsed = time.perf_counter() - start_time
+
+    stats = {
+        "elements": num_elements,
+        "chunks": -(-num_elements // chunk_size),
+        "elapsed_s": elapsed,
+        "elements_per_s": num_elements / elapsed if elapsed > 0 else float("inf"),
+    }
+    return updated_values.reshape(delta_in.shape), overflow_flags.reshape(delta_in.shape), stats
+
+
+# Main execution
+if __name__ == "__main__":
+    # Inputs
+    sign_bits = np.random.choice([0, 1], INPUT_SIZE)  # Random 0/1 values for sign bits
+    delta_input = np.random.uniform(-10, 10, INPUT_SIZE)  # Random real values for delta_input
+    quantized_inliers = np.random.randint(INT_MIN, INT_MAX, INPUT_SIZE)  # Random integer inliers
+    outlier_bitmap = np.random.choice([0, 1], INPUT_SIZE)  # Random 0/1 values for outlier_bitmap
+    overflow_flags = np.zeros(INPUT_SIZE, dtype=bool)  # Flags for overflow
+
+    # Step 1: Convert integers to floating-point
+    decompressed_inliers = int2fp_conversion(quantized_inliers, overflow_flags)
+
+    # Step 2: Decompress outliers from the compressed (index, value) stream
+    outlier_indices, outlier_values = compress_outliers(outlier_bitmap, delta_input)
+    decompressed_outliers = decompress_outlier_stream(outlier_indices, outlier_values, delta_input.shape)
+
+    # Step 3: Apply the ReLU function with the bit-packed sign mask
+    packed_sign_bits = np.packbits(sign_bits.astype(bool))
+    relu_output = relu_on_delta(packed_sign_bits, delta_input)
+
+    # Combine outputs (if necessary)
+    updated_values = decompressed_inliers + decompressed_outliers + relu_output
+
+    # Display results
+    print("Decompressed Inliers:", decompressed_inliers)
+    print("Decompressed Outliers:", decompressed_outliers)
+    print("ReLU Output:", relu_output)
+    print("Updated Values:", updated_values)
+    print("Overflow Flags:", overflow_flags)
+
+    # Sign-mask storage for this input and for a GUID-512 feature map (128x128x512)
+    for name, num_activations in (("Input", INPUT_SIZE), ("GUID 512", 128 * 128 * 512)):
+        sign_mask_bytes, full_precision_bytes, bytes_saved = sign_mask_storage(num_activations)
+        print(f"{name} sign mask: {sign_mask_bytes} bytes vs {full_precision_bytes} bytes FP16, saved {bytes_saved} bytes")
+
+    # Outlier stream traffic versus a dense outlier array
+    stream_bytes, dense_bytes = outlier_stream_bytes(len(outlier_indices), INPUT_SIZE)
+    print(f"Outlier stream: {len(outlier_indices)} outliers, {stream_bytes} bytes vs {dense_bytes} bytes dense")
+
+    # Streaming SFU pipeline on a full GUID-512 feature map (128x128x512)
+    feature_map_shape = (128, 128, 512)
+    map_delta = np.random.uniform(-10, 10, feature_map_shape)
+    map_inliers = np.random.randint(INT_MIN, INT_MAX, feature_map_shape)
+    map_outlier_indices, map_outlier_values = compress_outliers(np.random.rand(*feature_map_shape) < 0.01, map_delta)
+    map_sign_bits = pack_sign_bits(np.random.uniform(-1, 1, feature_map_shape))
+
+    map_updated, map_overflow, stats = sfu_pipeline(map_inliers, map_delta, map_outlier_indices, map_outlier_values, map_sign_bits)
+    print(f"SFU pipeline: {stats['elements']} elements in {stats['chunks']} chunks, "
+          f"{stats['elapsed_s']:.3f} s, {stats['elements_per_s']:.3e} elements/s")
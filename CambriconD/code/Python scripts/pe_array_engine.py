@@ -0,0 +1,125 @@
+import numpy as np
+
+# Batched PE-array engine shared by pe_array_psum.py and pe_array_psum_ver2.py.
+# The scripts differ in their overflow rule and in which lanes calculate_dot_product
+# sends down the int path; both are passed in.
+
+# Most rows per chunk of simulate_rows: every chunk is transposed to a lanes-first
+# layout, which slows down sharply once the chunk no longer fits in cache
+MAX_CHUNK_ROWS = 1 << 10
+
+
+def quantize_rows(A, overflow_flags, max_outliers, int_max, int_min):
+    """
+    quantize_activations for every row of a (rows x lanes) activation matrix at
+    once: inliers are truncated towards zero like int(), and rows with more than
+    max_outliers overflowed elements saturate them to int_max or int_min.
+    """
+    quantized_A = A.astype(np.int64)  # Truncates towards zero like int()
+    np.putmask(quantized_A, overflow_flags, 0)
+
+    saturated = overflow_flags & (overflow_flags.sum(axis=1) > max_outliers)[:, None]
+    np.putmask(quantized_A, saturated, np.where(A > 0, int_max, int_min))
+    return quantized_A, overflow_flags
+
+
+def simulate_rows(A, W, quantize, int_path_overflowed, chunk_rows):
+    """
+    Batched simulate_PE_array: A is a (rows x lanes) activation matrix and W a
+    (lanes x cols) weight matrix, one column per PE column (or a single weight
+    vector). quantize(A_chunk) returns the quantized activations and overflow
+    flags of a chunk of rows; the int path takes the overflowed lanes if
+    int_path_overflowed, the inliers otherwise, and the fp path the rest. The
+    products are accumulated in the same order as calculate_dot_product so every
+    (row, col) result equals the per-vector one exactly. Rows are processed in
+    chunks of chunk_rows / cols, at most MAX_CHUNK_ROWS. Returns int_dot_product and fp_dot_product
+    (rows x cols, or rows for a weight vector), the quantized activations, the
+    overflow flags and the int and fp multiply counts per row.
+    """
+    A = np.asarray(A)
+    W = np.asarray(W)
+    weight_vector = W.ndim == 1
+    W = W[:, None] if weight_vector else W
+
+    # Products of a chunk are added lane by lane into (chunk x cols) accumulators,
+    # one after the other like the per-vector loop; a lane on the other path is
+    # skipped, as adding its 0.0 would be. The chunk is transposed once so each
+    # lane is a contiguous row
+    rows, cols = A.shape[0], W.shape[1]
+    chunk_rows = min(max(1, chunk_rows // cols), MAX_CHUNK_ROWS)
+    quantized_A = np.empty(A.shape, dtype=np.int64)
+    overflow_flags = np.empty(A.shape, dtype=bool)
+    int_dot_product = np.empty((rows, cols))
+    fp_dot_product = np.empty((rows, cols))
+    int_multiply = np.empty(rows, dtype=np.int64)
+    for start in range(0, rows, chunk_rows):
+        stop = min(start + chunk_rows, rows)
+        quantized_A[start:stop], overflow_flags[start:stop] = quantize(A[start:stop])
+        int_mask = overflow_flags[start:stop] if int_path_overflowed else ~overflow_flags[start:stop]
+        int_multiply[start:stop] = int_mask.sum(axis=1)
+
+        int_lanes = np.ascontiguousarray(int_mask.T)
+        fp_lanes = ~int_lanes
+        quantized_lanes = np.ascontiguousarray(quantized_A[start:stop].T)
+        activation_lanes = np.ascontiguousarray(A[start:stop].T)
+        int_acc = np.zeros((stop - start, cols))
+        fp_acc = np.zeros((stop - start, cols))
+        products = np.empty((stop - start, cols))
+        for lane in range(A.shape[1]):
+            np.multiply(quantized_lanes[lane][:, None], W[lane], out=products)
+            np.add(int_acc, products, out=int_acc, where=int_lanes[lane][:, None])
+            np.multiply(activation_lanes[lane][:, None], W[lane], out=products)
+            np.add(fp_acc, products, out=fp_acc, where=fp_lanes[lane][:, None])
+        int_dot_product[start:stop] = int_acc
+        fp_dot_product[start:stop] = fp_acc
+
+    fp_multiply = A.shape[1] - int_multiply
+    if weight_vector:
+        int_dot_product, fp_dot_product = int_dot_product[:, 0], fp_dot_product[:, 0]
+    return int_dot_product, fp_dot_product, quantized_A, overflow_flags, int_multiply, fp_multiply
+
+
+def accumulate_fold_psums(A, W, simulate, fold_lanes, psum_bits):
+    """
+    A is the (rows x K) activation matrix of an output tile, one row per output
+    position with K = Kh*Kw*Cin, and W the (K x cols) weight matrix. The
+    reduction is split into folds of fold_lanes lanes (the last one zero-padded);
+    every fold runs simulate(A_fold, W_fold) and its int and fp partial sums are
+    added, truncated to an integer, into the psum_bits-wide accumulators of the
+    whole tile. An accumulator that leaves the psum_bits range is flagged and
+    saturated. The first fold only writes the psum buffer; every later fold
+    reads the tile back and writes it again.
+
+    Returns the (rows x cols) psums and a dict with the per-fold psum buffer
+    reads, writes and new overflows, and the mask of overflowed accumulators.
+    """
+    A = np.asarray(A)
+    W = np.asarray(W)
+    rows, K = A.shape
+    cols = W.shape[1]
+    folds = -(-K // fold_lanes)
+    psum_max = (1 << (psum_bits - 1)) - 1
+    psum_min = -(1 << (psum_bits - 1))
+
+    psums = np.zeros((rows, cols), dtype=np.int64)
+    overflowed = np.zeros((rows, cols), dtype=bool)
+    stats = {"folds": folds, "psum_reads": [], "psum_writes": [], "overflows": []}
+    for fold in range(folds):
+        lanes = slice(fold * fold_lanes, min((fold + 1) * fold_lanes, K))
+        A_fold = np.zeros((rows, fold_lanes), dtype=A.dtype)
+        W_fold = np.zeros((fold_lanes, cols))
+        A_fold[:, :lanes.stop - lanes.start] = A[:, lanes]
+        W_fold[:lanes.stop - lanes.start] = W[lanes]
+        int_psum, fp_psum, _, _, _, _ = simulate(A_fold, W_fold)
+
+        # Wide add, then check the result against the accumulator width
+        psums += np.trunc(int_psum + fp_psum).astype(np.int64)
+        new_overflows = ((psums > psum_max) | (psums < psum_min)) & ~overflowed
+        overflowed |= new_overflows
+        np.clip(psums, psum_min, psum_max, out=psums)
+
+        stats["psum_reads"].append(0 if fold == 0 else psums.size)
+        stats["psum_writes"].append(psums.size)
+        stats["overflows"].append(int(new_overflows.sum()))
+    stats["overflowed"] = overflowed
+    return psums, stats
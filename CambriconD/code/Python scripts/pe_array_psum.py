@@ -1,5 +1,7 @@
 import numpy as np
 
+from pe_array_engine import accumulate_fold_psums, quantize_rows, simulate_rows
+
 # Define parameters
 PE_ARRAY_SIZE_X = 128
 PE_ARRAY_SIZE_Y = 128
@@ -11,6 +13,10 @@ THRESHOLD = 100.0
 N = 60
 M = 4
 
+BATCH_ROWS = 1 << 16  # Activation vectors in the batched example run
+BATCH_CHUNK_ROWS = 1 << 14  # Rows per chunk of the batched engine, divided by the weight columns
+PSUM_BITS = 32  # Width of the partial-sum accumulators (at most 63)
+
 # Define input arrays
 A = np.random.rand(INPUT_SIZE) * 500 - 100   # Random values in range [-100, 100]
 W = np.random.rand(INPUT_SIZE) * 2 - 1       # Random values in range [-1, 1]
@@ -47,6 +53,14 @@ def quantize_activations(A, W):
     return quantized_A, overflow_flags
 
 
+def quantize_activations_batched(A):
+    """
+    quantize_activations for every row of a (rows x INPUT_SIZE) activation
+    matrix at once, with the outlier budget M applied per row.
+    """
+    return quantize_rows(A, A > THRESHOLD, M, INT_MAX, INT_MIN)
+
+
 def calculate_dot_product(A, quantized_A, W, overflow_flags):
     int_dot_product = 0
     fp_dot_product = 0
@@ -80,6 +94,25 @@ def simulate_PE_array(A, W):
     return int_dot_product, fp_dot_product, quantized_inliers, overflow_flags
 
 
+# Simulate the whole PE array on a batch of activation vectors
+def simulate_PE_array_batched(A, W, chunk_rows=BATCH_CHUNK_ROWS):
+    """
+    Batched simulate_PE_array on a (rows x INPUT_SIZE) activation matrix and an
+    (INPUT_SIZE x cols) weight matrix or weight vector, bit-exact with the
+    per-vector run; inliers go to the int multipliers. See pe_array_engine.simulate_rows.
+    """
+    return simulate_rows(A, W, quantize_activations_batched, False, chunk_rows)
+
+
+# Accumulate the partial sums of an output tile across its reduction folds
+def accumulate_psums(A, W, psum_bits=PSUM_BITS):
+    """
+    psum_bits-wide psums of a (rows x Kh*Kw*Cin) output tile over its folds of
+    INPUT_SIZE lanes; see pe_array_engine.accumulate_fold_psums.
+    """
+    return accumulate_fold_psums(A, W, simulate_PE_array_batched, INPUT_SIZE, psum_bits)
+
+
 # Run the simulation
 int_dot_product, fp_dot_product, quantized_inliers, overflow_flags = simulate_PE_array(A, W)
 
@@ -95,3 +128,20 @@ psum = inlier_dot_product+ outlier_dot_product
 print("psum: ",psum)
 #print("Psum: ",)
 
+# Batched run: the first row reproduces the per-vector simulation exactly
+A_batch = np.vstack([A[None, :], np.random.rand(BATCH_ROWS - 1, INPUT_SIZE) * 500 - 100])
+batch_int, batch_fp, batch_quantized, batch_flags, _, _ = simulate_PE_array_batched(A_batch, W)
+assert batch_int[0] == int_dot_product and batch_fp[0] == fp_dot_product
+assert np.array_equal(batch_quantized[0], quantized_inliers) and np.array_equal(batch_flags[0], overflow_flags)
+print(f"Batched PE array: {A_batch.shape[0]} vectors, {batch_flags.sum()} outliers")
+
+# Output tile of a large-Cin layer: psums accumulated over its Kh*Kw*Cin folds
+Kh, Kw, Cin = 3, 3, 256
+A_tile = np.random.rand(PE_ARRAY_SIZE_X, Kh * Kw * Cin) * 500 - 100
+W_tile = np.random.rand(Kh * Kw * Cin, PE_ARRAY_SIZE_Y) * 2 - 1
+psums, psum_stats = accumulate_psums(A_tile, W_tile)
+psum_bytes = (sum(psum_stats["psum_reads"]) + sum(psum_stats["psum_writes"])) * PSUM_BITS // 8
+operand_bytes = A_tile.size * A_tile.itemsize + W_tile.size * W_tile.itemsize
+print(f"Psum buffer: {psum_stats['folds']} folds, {sum(psum_stats['psum_reads'])} reads, "
+      f"{sum(psum_stats['psum_writes'])} writes ({psum_bytes} bytes vs {operand_bytes} operand bytes), "
+      f"{sum(psum_stats['overflows'])} overflows at {PSUM_BITS} bits")
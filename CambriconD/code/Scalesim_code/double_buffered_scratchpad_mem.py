@@ -0,0 +1,297 @@
+import bisect
+import math
+import numpy as np
+from trace_io import DEFAULT_CHUNK_ROWS, address_dtype, trace_writer, write_trace
+
+class double_buffered_scratchpad:
+    """
+    ifmap, filter and ofmap SRAM scratchpads with DRAM behind them. Each buffer
+    is split into prefetch_distance + 1 partitions: compute works out of one
+    while DRAM fills (reads) or drains (ofmap writes) the others, so with the
+    default prefetch distance of 1 every buffer is double buffered.
+
+    The demand matrices of a compute system (one row per compute cycle, -1 for
+    no request) are cut into windows whose distinct addresses fit one partition.
+    A read window has to be filled before its first cycle and a write window
+    needs a drained partition; when DRAM cannot keep up, compute stalls.
+    """
+    def __init__(self):
+        self.word_size = 1  # Bytes per word
+        self.ifmap_buf_size_bytes = 256 * 1024
+        self.filter_buf_size_bytes = 256 * 1024
+        self.ofmap_buf_size_bytes = 128 * 1024
+        self.ifmap_dram_bw = 10  # Words per cycle
+        self.filter_dram_bw = 10
+        self.ofmap_dram_bw = 10
+        self.prefetch_distance = 1  # Windows DRAM may run ahead of compute
+
+        self.ifmap_demand_mat = np.zeros((0, 1), dtype=np.int64)
+        self.filter_demand_mat = np.zeros((0, 1), dtype=np.int64)
+        self.ofmap_demand_mat = np.zeros((0, 1), dtype=np.int64)
+
+        # Results of service_memory_requests
+        self.total_cycles = 0
+        self.stall_cycles = 0
+        self.stall_rows = []  # Demand rows at which compute stalled
+        self.stall_totals = []  # Total stall cycles from each of those rows on
+        self.windows = {}
+        self.dram_schedule = {}
+
+        self.params_set_flag = False
+        self.requests_serviced_flag = False
+
+    def set_params(self, word_size=1, ifmap_buf_size_kb=256, filter_buf_size_kb=256, ofmap_buf_size_kb=128,
+                   ifmap_dram_bw=10, filter_dram_bw=10, ofmap_dram_bw=10, prefetch_distance=1):
+        if prefetch_distance < 1:
+            raise ValueError(f"prefetch_distance must be at least 1, got {prefetch_distance}.")
+        self.word_size = word_size
+        self.ifmap_buf_size_bytes = ifmap_buf_size_kb * 1024
+        self.filter_buf_size_bytes = filter_buf_size_kb * 1024
+        self.ofmap_buf_size_bytes = ofmap_buf_size_kb * 1024
+        self.ifmap_dram_bw = ifmap_dram_bw
+        self.filter_dram_bw = filter_dram_bw
+        self.ofmap_dram_bw = ofmap_dram_bw
+        self.prefetch_distance = prefetch_distance
+        self.params_set_flag = True
+        self.requests_serviced_flag = False
+
+    def _partition_words(self, buf_size_bytes):
+        return max(1, buf_size_bytes // self.word_size // (self.prefetch_distance + 1))
+
+    @staticmethod
+    def _windows(demand_mat, capacity):
+        """
+        Cuts the demand rows into consecutive windows of at most capacity distinct
+        addresses (a single row always forms a window). Returns the start rows,
+        end rows and distinct address counts of the windows.
+        """
+        rows, lanes = demand_mat.shape
+        starts, ends, counts = [], [], []
+        start = 0
+        lookahead = max(1, capacity // max(lanes, 1))
+        while start < rows:
+            # Grow the lookahead until it holds more than capacity distinct addresses or reaches the end
+            while True:
+                stop = min(rows, start + lookahead)
+                flat = demand_mat[start:stop].ravel()
+                valid = np.flatnonzero(flat != -1)
+                _, first = np.unique(flat[valid], return_index=True)
+                new_per_row = np.bincount(valid[first] // lanes, minlength=stop - start)
+                distinct = np.cumsum(new_per_row)
+                if stop == rows or distinct[-1] > capacity:
+                    break
+                lookahead *= 2
+            length = max(1, int(np.searchsorted(distinct, capacity, side='right')))
+            starts.append(start)
+            ends.append(start + length)
+            counts.append(int(distinct[length - 1]))
+            start += length
+        return starts, ends, counts
+
+    def _stall_before(self, row):
+        """Stall cycles accumulated before demand row `row` is serviced."""
+        index = bisect.bisect_right(self.stall_rows, row) - 1
+        return self.stall_totals[index] if index >= 0 else 0
+
+    def service_memory_requests(self, ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat, trace_paths=None,
+                                chunk_rows=DEFAULT_CHUNK_ROWS, compress=True):
+        """
+        Services the demand matrices of one layer: schedules every DRAM fill and
+        drain, and the compute stalls they cause.
+
+        trace_paths maps operands ('ifmap', 'filter', 'ofmap') to trace
+        directories: their SRAM traces are streamed to chunked binary traces
+        (see trace_io) while the requests are serviced. The serviced cycles of
+        the rows before a window start are final once the loop reaches it.
+        """
+        self.ifmap_demand_mat = np.asarray(ifmap_demand_mat)
+        self.filter_demand_mat = np.asarray(filter_demand_mat)
+        self.ofmap_demand_mat = np.asarray(ofmap_demand_mat)
+        rows = self.ifmap_demand_mat.shape[0]
+        if self.filter_demand_mat.shape[0] != rows or self.ofmap_demand_mat.shape[0] != rows:
+            raise ValueError("Demand matrices must have one row per compute cycle.")
+
+        operands = {
+            'ifmap': (self.ifmap_demand_mat, self.ifmap_buf_size_bytes, self.ifmap_dram_bw),
+            'filter': (self.filter_demand_mat, self.filter_buf_size_bytes, self.filter_dram_bw),
+            'ofmap': (self.ofmap_demand_mat, self.ofmap_buf_size_bytes, self.ofmap_dram_bw),
+        }
+        self.windows = {name: self._windows(demand, self._partition_words(size))
+                        for name, (demand, size, _) in operands.items()}
+        self.dram_schedule = {name: {'start': [], 'end': [], 'words': []} for name in operands}
+        self.stall_rows, self.stall_totals = [], []
+
+        # Window events in demand-row order; reads are filled before writes at the same row
+        events = sorted((start, name == 'ofmap', name, k)
+                        for name, (starts, _, _) in self.windows.items() for k, start in enumerate(starts))
+        dram_free = dict.fromkeys(operands, 0)
+        writers = {name: trace_writer(path, operands[name][0].shape[1], chunk_rows, compress,
+                                      address_dtype(operands[name][0]))
+                   for name, path in (trace_paths or {}).items()}
+        traced = 0
+        stall = 0
+        for start, is_write, name, k in events:
+            if writers and start - traced >= chunk_rows:
+                self._stream_traces(writers, operands, traced, start)
+                traced = start
+            starts, ends, counts = self.windows[name]
+            bw = operands[name][2]
+            if not is_write:
+                # The partition is free once the window prefetch_distance + 1 back has been consumed
+                previous = k - self.prefetch_distance - 1
+                partition_free = ends[previous] + self._stall_before(ends[previous] - 1) if previous >= 0 else 0
+                fill_start = max(dram_free[name], partition_free)
+                ready = fill_start + math.ceil(counts[k] / bw)
+                self._schedule(name, fill_start, ready, counts[k])
+                dram_free[name] = ready
+            else:
+                # Drain the finished windows, the one prefetch_distance + 1 back has to be written out
+                ready = 0
+                for j in range(len(self.dram_schedule['ofmap']['start']), k - self.prefetch_distance):
+                    drain_start = max(dram_free[name], ends[j] + self._stall_before(ends[j] - 1))
+                    dram_free[name] = drain_start + math.ceil(counts[j] / bw)
+                    self._schedule(name, drain_start, dram_free[name], counts[j])
+                if k - self.prefetch_distance - 1 >= 0:
+                    ready = self.dram_schedule['ofmap']['end'][k - self.prefetch_distance - 1]
+            if ready > start + stall:
+                stall = ready - start
+                self.stall_rows.append(start)
+                self.stall_totals.append(stall)
+
+        # Write out the remaining ofmap windows after the last compute cycle
+        _, ends, counts = self.windows['ofmap']
+        for j in range(len(self.dram_schedule['ofmap']['start']), len(ends)):
+            drain_start = max(dram_free['ofmap'], ends[j] + stall)
+            dram_free['ofmap'] = drain_start + math.ceil(counts[j] / self.ofmap_dram_bw)
+            self._schedule('ofmap', drain_start, dram_free['ofmap'], counts[j])
+
+        self.stall_cycles = stall
+        self.total_cycles = rows + stall
+        self.requests_serviced_flag = True
+
+        if writers:
+            self._stream_traces(writers, operands, traced, rows)
+            for writer in writers.values():
+                writer.close()
+
+    def _stream_traces(self, writers, operands, start, stop):
+        cycles = self.serviced_cycles(start, stop)
+        for name, writer in writers.items():
+            writer.append(cycles, operands[name][0][start:stop])
+
+    def _schedule(self, name, start, end, words):
+        self.dram_schedule[name]['start'].append(start)
+        self.dram_schedule[name]['end'].append(end)
+        self.dram_schedule[name]['words'].append(words)
+
+    def serviced_cycles(self, start=0, stop=None):
+        """Cycle at which each demand row (from start to stop) is serviced, stalls included."""
+        stop = self.ifmap_demand_mat.shape[0] if stop is None else stop
+        rows = np.arange(start, stop)
+        if not self.stall_rows:
+            return rows
+        index = np.searchsorted(self.stall_rows, rows, side='right') - 1
+        totals = np.asarray(self.stall_totals)
+        return rows + np.where(index >= 0, totals[np.maximum(index, 0)], 0)
+
+    def get_total_compute_cycles(self):
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        return self.total_cycles
+
+    def get_stall_cycles(self):
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        return self.stall_cycles
+
+    def _sram_details(self, demand_mat):
+        requested = np.flatnonzero((demand_mat != -1).any(axis=1))
+        if requested.size == 0:
+            return 0, 0, 0
+        cycles = self.serviced_cycles()
+        return int(cycles[requested[0]]), int(cycles[requested[-1]]), int(np.count_nonzero(demand_mat != -1))
+
+    def get_ifmap_sram_details(self):
+        """(start cycle, stop cycle, reads) of the ifmap SRAM."""
+        return self._sram_details(self.ifmap_demand_mat)
+
+    def get_filter_sram_details(self):
+        return self._sram_details(self.filter_demand_mat)
+
+    def get_ofmap_sram_details(self):
+        """(start cycle, stop cycle, writes) of the ofmap SRAM."""
+        return self._sram_details(self.ofmap_demand_mat)
+
+    def _dram_details(self, name):
+        schedule = self.dram_schedule[name]
+        if not schedule['start']:
+            return 0, 0, 0
+        return schedule['start'][0], schedule['end'][-1], sum(schedule['words'])
+
+    def get_ifmap_dram_details(self):
+        """(start cycle, stop cycle, words read) of the ifmap DRAM traffic."""
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        return self._dram_details('ifmap')
+
+    def get_filter_dram_details(self):
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        return self._dram_details('filter')
+
+    def get_ofmap_dram_details(self):
+        """(start cycle, stop cycle, words written) of the ofmap DRAM traffic."""
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        return self._dram_details('ofmap')
+
+    def _avg_bw(self, details):
+        start, stop, words = details
+        return words / (stop - start) if stop > start else 0
+
+    def get_avg_ifmap_bw(self):
+        """Average ifmap SRAM bandwidth in words per cycle while it is active."""
+        return self._avg_bw(self.get_ifmap_sram_details())
+
+    def get_avg_filter_bw(self):
+        return self._avg_bw(self.get_filter_sram_details())
+
+    def get_avg_ofmap_bw(self):
+        return self._avg_bw(self.get_ofmap_sram_details())
+
+    def get_avg_ifmap_dram_bw(self):
+        """Average ifmap DRAM bandwidth in words per cycle while it is active."""
+        return self._avg_bw(self.get_ifmap_dram_details())
+
+    def get_avg_filter_dram_bw(self):
+        return self._avg_bw(self.get_filter_dram_details())
+
+    def get_avg_ofmap_dram_bw(self):
+        return self._avg_bw(self.get_ofmap_dram_details())
+
+    def _print_trace(self, filename, demand_mat):
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        cycles = self.serviced_cycles()
+        with open(filename, 'w') as f:
+            for start in range(0, demand_mat.shape[0], DEFAULT_CHUNK_ROWS):
+                stop = start + DEFAULT_CHUNK_ROWS
+                np.savetxt(f, np.concatenate((cycles[start:stop, None], demand_mat[start:stop]), axis=1),
+                           fmt='%d', delimiter=',')
+
+    def print_ifmap_sram_trace(self, filename):
+        self._print_trace(filename, self.ifmap_demand_mat)
+
+    def print_filter_sram_trace(self, filename):
+        self._print_trace(filename, self.filter_demand_mat)
+
+    def print_ofmap_sram_trace(self, filename):
+        self._print_trace(filename, self.ofmap_demand_mat)
+
+    def _save_trace(self, path, demand_mat, chunk_rows, compress):
+        assert self.requests_serviced_flag, 'Memory requests not serviced'
+        write_trace(path, self.serviced_cycles(), demand_mat, chunk_rows, compress)
+
+    def save_ifmap_sram_trace(self, path, chunk_rows=DEFAULT_CHUNK_ROWS, compress=True):
+        """Writes the ifmap SRAM trace as a chunked binary trace directory (see trace_io)."""
+        self._save_trace(path, self.ifmap_demand_mat, chunk_rows, compress)
+
+    def save_filter_sram_trace(self, path, chunk_rows=DEFAULT_CHUNK_ROWS, compress=True):
+        self._save_trace(path, self.filter_demand_mat, chunk_rows, compress)
+
+    def save_ofmap_sram_trace(self, path, chunk_rows=DEFAULT_CHUNK_ROWS, compress=True):
+        self._save_trace(path, self.ofmap_demand_mat, chunk_rows, compress)
@@ -1,19 +1,28 @@
 import os
 import numpy as np
-from scalesim.topology_utils import topologies as topo
-from scalesim.compute.operand_matrix import operand_matrix as opmat
-from scalesim.memory.double_buffered_scratchpad_mem import double_buffered_scratchpad as mem_dbsp
-from scalesim.compute.systolic_compute_os import systolic_compute_os,scale_config  # Make sure to properly import your systolic_compute_os
+from double_buffered_scratchpad_mem import double_buffered_scratchpad as mem_dbsp
+from systolic_compute_os import systolic_compute_os,scale_config
+from systolic_compute_ws import systolic_compute_ws
+from systolic_compute_is import systolic_compute_is
+from trace_io import DEFAULT_CHUNK_ROWS
+
+# Compute system of each dataflow
+COMPUTE_SYSTEMS = {
+    'os': systolic_compute_os,
+    'ws': systolic_compute_ws,
+    'is': systolic_compute_is,
+}
 
 class single_layer_sim:
     def __init__(self):
         self.layer_id = 0
-        self.topo = topo()  # Ensure that 'topo' is correctly defined or imported
+        self.topo = None  # ScaleSim topology, only needed without operand_matrices
         self.config = scale_config()  # Assuming scale_config is a correctly defined or imported configuration class
 
-        self.op_mat_obj = opmat()  # Operand matrix object, ensure it's defined or imported correctly
+        self.op_mat_obj = None  # ScaleSim operand matrix object, built from the topology
         self.compute_system = None  # This will be set in set_params based on the dataflow type
         self.memory_system = mem_dbsp()  # Memory system object, ensure it's defined or imported correctly
+        self.operand_matrices = None  # Operand matrices given to set_params instead of the topology
 
         self.verbose = True
         self.initialize_report_items()
@@ -65,34 +74,46 @@ class single_layer_sim:
         self.ofmap_dram_stop_cycle = 0
         self.ofmap_dram_writes = 0
 
-    def set_params(self, layer_id=0, config_obj=None, topology_obj=None, verbose=True):
+    def set_params(self, layer_id=0, config_obj=None, topology_obj=None, verbose=True, operand_matrices=None):
         self.layer_id = layer_id
         self.config = config_obj if config_obj else self.config
         self.topo = topology_obj if topology_obj else self.topo
 
-        self.op_mat_obj.set_params(layer_id=self.layer_id, config_obj=self.config, topoutil_obj=self.topo)
-        config = scale_config()
-        scos = systolic_compute_os(config)
+        # (ifmap, filter, ofmap) operand matrices given directly, e.g. from conv_operand_matrices;
+        # otherwise they come from the topology through the external scalesim package
+        self.operand_matrices = operand_matrices
+        if self.operand_matrices is None:
+            from scalesim.topology_utils import topologies as topo
+            from scalesim.compute.operand_matrix import operand_matrix as opmat
+            self.topo = self.topo if self.topo else topo()
+            self.op_mat_obj = opmat()
+            self.op_mat_obj.set_params(layer_id=self.layer_id, config_obj=self.config, topoutil_obj=self.topo)
         self.dataflow = self.config.get_dataflow()
-        if self.dataflow == 'os':
-            self.compute_system = systolic_compute_os(self.config)
-        elif self.dataflow == 'ws':
-            # self.compute_system = systolic_compute_ws(self.config)
-            pass
-        elif self.dataflow == 'is':
-            # self.compute_system = systolic_compute_is(self.config)
-            pass
+        if self.dataflow not in COMPUTE_SYSTEMS:
+            raise ValueError(f"Unknown dataflow {self.dataflow!r}, expected one of {tuple(COMPUTE_SYSTEMS)}.")
+        self.compute_system = COMPUTE_SYSTEMS[self.dataflow](self.config)
 
         self.num_mac_unit = self.config.get_array_dims()[0] * self.config.get_array_dims()[1]
         self.verbose = verbose
         self.params_set_flag = True
 
-    def run(self):
+    def run(self, trace_path=None, trace_format='npz', chunk_rows=DEFAULT_CHUNK_ROWS):
+        """
+        Simulates the layer. With trace_path, the SRAM traces are streamed to
+        chunked binary traces ('npz' compressed, 'npy' uncompressed) under
+        trace_path while the memory requests are serviced, in the layout of
+        save_traces.
+        """
         assert self.params_set_flag, 'Parameters are not set. Run set_params()'
+        if trace_path is not None and trace_format not in ('npz', 'npy'):
+            raise ValueError(f"Traces can only be streamed as 'npz' or 'npy', got {trace_format!r}.")
         # Fetch operand matrices
-        ifmap_matrix = self.op_mat_obj.get_ifmap_matrix()
-        filter_matrix = self.op_mat_obj.get_filter_matrix()
-        ofmap_matrix = self.op_mat_obj.get_ofmap_matrix()
+        if self.operand_matrices is not None:
+            ifmap_matrix, filter_matrix, ofmap_matrix = self.operand_matrices
+        else:
+            ifmap_matrix = self.op_mat_obj.get_ifmap_matrix()
+            filter_matrix = self.op_mat_obj.get_filter_matrix()
+            ofmap_matrix = self.op_mat_obj.get_ofmap_matrix()
         
         # Set compute system parameters with operand matrices
         self.compute_system.set_params(ifmap_op_mat=ifmap_matrix,
@@ -107,23 +128,60 @@ class single_layer_sim:
         if not self.memory_system_ready_flag:
             self.configure_memory_system()
 
-        # Service memory requests
-        self.memory_system.service_memory_requests(ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat)
+        # Service memory requests, streaming the traces if requested
+        trace_paths = None
+        if trace_path is not None:
+            dir_name = self._trace_dir(trace_path)
+            trace_paths = {name: os.path.join(dir_name, f'{name.upper()}_SRAM_TRACE')
+                           for name in ('ifmap', 'filter', 'ofmap')}
+        self.memory_system.service_memory_requests(ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat,
+                                                   trace_paths, chunk_rows, trace_format == 'npz')
 
         # Mark simulation run as complete
         self.runs_ready = True
 
 
-    def save_traces(self, top_path):
-        assert self.runs_ready, 'Simulation runs are not complete.'
-        # Define directory and file paths
+    def configure_memory_system(self):
+        # Scratchpad sizes, DRAM bandwidth and prefetch distance from the config
+        ifmap_sram_kb, filter_sram_kb, ofmap_sram_kb = self.config.get_mem_sizes()
+        self.memory_system.set_params(word_size=self.config.word_size,
+                                      ifmap_buf_size_kb=ifmap_sram_kb,
+                                      filter_buf_size_kb=filter_sram_kb,
+                                      ofmap_buf_size_kb=ofmap_sram_kb,
+                                      ifmap_dram_bw=self.config.dram_bw,
+                                      filter_dram_bw=self.config.dram_bw,
+                                      ofmap_dram_bw=self.config.dram_bw,
+                                      prefetch_distance=self.config.prefetch_distance)
+        self.memory_system_ready_flag = True
+
+    def _trace_dir(self, top_path):
         dir_name = os.path.join(top_path, f'layer_{self.layer_id}')
         os.makedirs(dir_name, exist_ok=True)
+        return dir_name
+
+    def save_traces(self, top_path, trace_format='npz', chunk_rows=DEFAULT_CHUNK_ROWS):
+        """
+        Saves the SRAM traces of the layer after run(). 'npz' writes compressed
+        chunked traces, 'npy' uncompressed ones that trace_io.trace_reader can
+        memory-map, and 'csv' the plain CSV files. Binary traces can also be
+        streamed during the run, see run(trace_path=...).
+        """
+        assert self.runs_ready, 'Simulation runs are not complete.'
+        if trace_format not in ('npz', 'npy', 'csv'):
+            raise ValueError(f"Unknown trace format {trace_format!r}, expected 'npz', 'npy' or 'csv'.")
+        # Define directory and file paths
+        dir_name = self._trace_dir(top_path)
 
         # Save traces from memory system
-        self.memory_system.print_ifmap_sram_trace(os.path.join(dir_name, 'IFMAP_SRAM_TRACE.csv'))
-        self.memory_system.print_filter_sram_trace(os.path.join(dir_name, 'FILTER_SRAM_TRACE.csv'))
-        self.memory_system.print_ofmap_sram_trace(os.path.join(dir_name, 'OFMAP_SRAM_TRACE.csv'))
+        if trace_format == 'csv':
+            self.memory_system.print_ifmap_sram_trace(os.path.join(dir_name, 'IFMAP_SRAM_TRACE.csv'))
+            self.memory_system.print_filter_sram_trace(os.path.join(dir_name, 'FILTER_SRAM_TRACE.csv'))
+            self.memory_system.print_ofmap_sram_trace(os.path.join(dir_name, 'OFMAP_SRAM_TRACE.csv'))
+        else:
+            compress = trace_format == 'npz'
+            self.memory_system.save_ifmap_sram_trace(os.path.join(dir_name, 'IFMAP_SRAM_TRACE'), chunk_rows, compress)
+            self.memory_system.save_filter_sram_trace(os.path.join(dir_name, 'FILTER_SRAM_TRACE'), chunk_rows, compress)
+            self.memory_system.save_ofmap_sram_trace(os.path.join(dir_name, 'OFMAP_SRAM_TRACE'), chunk_rows, compress)
 
         # If detailed DRAM traces are required, ensure methods are defined to handle them
         # Example: self.memory_system.print_ifmap_dram_trace(os.path.join(dir_name, 'IFMAP_DRAM_TRACE.csv'))
@@ -134,6 +192,7 @@ class single_layer_sim:
         # Calculate total cycles, stalls, and utilization
         self.total_cycles = self.memory_system.get_total_compute_cycles()
         self.stall_cycles = self.memory_system.get_stall_cycles()
+        self.num_compute = self.compute_system.get_num_compute()
         self.overall_util = (self.num_compute * 100) / (self.total_cycles * self.num_mac_unit)
 
         # Efficiency metrics
@@ -144,6 +203,23 @@ class single_layer_sim:
         self.avg_ifmap_sram_bw = self.memory_system.get_avg_ifmap_bw()
         self.avg_filter_sram_bw = self.memory_system.get_avg_filter_bw()
         self.avg_ofmap_sram_bw = self.memory_system.get_avg_ofmap_bw()
+        self.avg_ifmap_dram_bw = self.memory_system.get_avg_ifmap_dram_bw()
+        self.avg_filter_dram_bw = self.memory_system.get_avg_filter_dram_bw()
+        self.avg_ofmap_dram_bw = self.memory_system.get_avg_ofmap_dram_bw()
+
+        # SRAM and DRAM activity windows and access counts
+        self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle, self.ifmap_sram_reads = \
+            self.memory_system.get_ifmap_sram_details()
+        self.filter_sram_start_cycle, self.filter_sram_stop_cycle, self.filter_sram_reads = \
+            self.memory_system.get_filter_sram_details()
+        self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle, self.ofmap_sram_writes = \
+            self.memory_system.get_ofmap_sram_details()
+        self.ifmap_dram_start_cycle, self.ifmap_dram_stop_cycle, self.ifmap_dram_reads = \
+            self.memory_system.get_ifmap_dram_details()
+        self.filter_dram_start_cycle, self.filter_dram_stop_cycle, self.filter_dram_reads = \
+            self.memory_system.get_filter_dram_details()
+        self.ofmap_dram_start_cycle, self.ofmap_dram_stop_cycle, self.ofmap_dram_writes = \
+            self.memory_system.get_ofmap_dram_details()
 
         self.report_items_ready = True
 
@@ -180,3 +256,31 @@ class single_layer_sim:
         items += [self.ofmap_dram_start_cycle, self.ofmap_dram_stop_cycle, self.ofmap_dram_writes]
 
         return items
+
+
+def compare_dataflows(ifmap_op_mat, filter_op_mat, ofmap_op_mat, config_obj, dataflows=tuple(COMPUTE_SYSTEMS)):
+    """
+    Runs the compute system of every dataflow on the same layer operand matrices.
+    Returns a dict per dataflow with the cycles, mapping efficiency, compute
+    utilization and the SRAM requests and average bandwidth (words per cycle) of
+    each operand, and the dataflow with the fewest cycles.
+    """
+    report = {}
+    for dataflow in dataflows:
+        compute_system = COMPUTE_SYSTEMS[dataflow](config_obj)
+        compute_system.set_params(ifmap_op_mat=ifmap_op_mat, filter_op_mat=filter_op_mat, ofmap_op_mat=ofmap_op_mat)
+        cycles = compute_system.get_total_cycles()
+        requests = {
+            'ifmap': compute_system.get_ifmap_requests(),
+            'filter': compute_system.get_filter_requests(),
+            'ofmap': compute_system.get_ofmap_requests(),
+        }
+        report[dataflow] = {
+            'cycles': cycles,
+            'mapping_eff': compute_system.get_avg_mapping_efficiency(),
+            'compute_util': compute_system.get_avg_compute_utilization(),
+            'sram_requests': requests,
+            'avg_sram_bw': {operand: count / cycles for operand, count in requests.items()},
+        }
+    best = min(report, key=lambda dataflow: report[dataflow]['cycles'])
+    return report, best
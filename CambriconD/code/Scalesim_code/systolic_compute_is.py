@@ -0,0 +1,17 @@
+from systolic_compute_ws import systolic_compute_ws
+
+class systolic_compute_is(systolic_compute_ws):
+    """
+    Input-stationary compute core: the weight-stationary schedule with the
+    operand roles swapped. The transposed (T x Sr) ifmap matrix is pinned to the
+    array in row folds of arr_row operands and column folds of arr_col output
+    pixels, the Sc filters stream through every fold and the ofmap is written
+    once per row fold.
+    """
+    def _roles(self):
+        """(T x X) stationary operand, (T x Y) streamed operand and (Y x X) outputs."""
+        return self.ifmap_op_mat.T, self.filter_op_mat, self.ofmap_op_mat.T
+
+    def _assign_roles(self, stationary, streaming):
+        """Maps the stationary and streamed matrices back to (ifmap, filter)."""
+        return stationary, streaming
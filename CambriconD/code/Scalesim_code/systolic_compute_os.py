@@ -1,119 +1,286 @@
 import math
 import numpy as np
-from tqdm import tqdm
+
+# Address offsets of the operands in the operand matrices (ScaleSim layout)
+IFMAP_OFFSET = 0
+FILTER_OFFSET = 10000000
+OFMAP_OFFSET = 20000000
 
 class scale_config:
-    def __init__(self):
-        self.array_rows = 10  # Number of rows in the systolic array
-        self.array_cols = 10  # Number of columns in the systolic array
-        self.quantization_threshold = 0.5  # Threshold for quantization
-        self.num_multiplier_fpfp = 1  # Number of FP-FP multipliers
+    def __init__(self, array_rows=10, array_cols=10, quantization_threshold=0.5, num_multiplier_fpfp=1, dataflow='os',
+                 ifmap_sram_kb=256, filter_sram_kb=256, ofmap_sram_kb=128, dram_bw=10, prefetch_distance=1, word_size=1):
+        self.array_rows = array_rows  # Number of rows in the systolic array
+        self.array_cols = array_cols  # Number of columns in the systolic array
+        self.quantization_threshold = quantization_threshold  # Threshold for quantization
+        self.num_multiplier_fpfp = num_multiplier_fpfp  # Number of FP-FP multipliers
+        self.dataflow = dataflow  # 'os', 'ws' or 'is'
+        self.ifmap_sram_kb = ifmap_sram_kb  # SRAM scratchpad sizes
+        self.filter_sram_kb = filter_sram_kb
+        self.ofmap_sram_kb = ofmap_sram_kb
+        self.dram_bw = dram_bw  # DRAM bandwidth of each scratchpad in words per cycle
+        self.prefetch_distance = prefetch_distance  # Windows DRAM may run ahead of compute
+        self.word_size = word_size  # Bytes per word
 
     def get_array_dims(self):
         return (self.array_rows, self.array_cols)
 
+    def get_dataflow(self):
+        return self.dataflow
+
+    def get_mem_sizes(self):
+        return (self.ifmap_sram_kb, self.filter_sram_kb, self.ofmap_sram_kb)
+
+def conv_operand_matrices(ifmap_h, ifmap_w, filt_h, filt_w, channels, num_filters, stride=1):
+    """
+    Address operand matrices of a convolution layer, as ScaleSim's operand_matrix
+    builds them: the (Sr x T) ifmap matrix holds the input window of every output
+    pixel, the (T x Sc) filter matrix one filter per column and the (Sr x Sc)
+    ofmap matrix the output addresses, with Sr output pixels, T = filt_h * filt_w
+    * channels and Sc = num_filters.
+    """
+    ofmap_h = (ifmap_h - filt_h) // stride + 1
+    ofmap_w = (ifmap_w - filt_w) // stride + 1
+
+    # Address of the first element of each window, then the offsets inside a window
+    out_rows, out_cols = np.divmod(np.arange(ofmap_h * ofmap_w), ofmap_w)
+    window_starts = (out_rows * stride * ifmap_w + out_cols * stride) * channels
+    fh, fw, ch = np.meshgrid(np.arange(filt_h), np.arange(filt_w), np.arange(channels), indexing='ij')
+    window_offsets = ((fh * ifmap_w + fw) * channels + ch).ravel()
+    ifmap_op_mat = IFMAP_OFFSET + window_starts[:, None] + window_offsets[None, :]
+
+    T = filt_h * filt_w * channels
+    filter_op_mat = FILTER_OFFSET + np.arange(T)[:, None] + np.arange(num_filters)[None, :] * T
+    ofmap_op_mat = OFMAP_OFFSET + np.arange(ofmap_h * ofmap_w * num_filters).reshape(-1, num_filters)
+    return ifmap_op_mat, filter_op_mat, ofmap_op_mat
+
 class systolic_compute_os:
+    """
+    Output-stationary compute core. The (Sr x Sc) ofmap is tiled onto the array
+    in row folds of arr_row output pixels and column folds of arr_col filters
+    (column folds outermost). Every fold streams its T operands through the
+    array and the ifmap/filter/ofmap demand matrices give, for every cycle, the
+    address each array row or column reads or writes (-1 for none).
+    """
     def __init__(self, config):
         self.config = config
 
-        self.arr_row, self.arr_col = 10,10#self.config.get_array_dims()
-        self.quantization_threshold = 0.5#self.config.quantization_threshold
-        self.num_multiplier_fpfp = 1#self.config.num_multiplier_fpfp
+        self.arr_row, self.arr_col = self.config.get_array_dims()
+        self.quantization_threshold = self.config.quantization_threshold
+        self.num_multiplier_fpfp = self.config.num_multiplier_fpfp
 
-        # Initialize matrices based on the array dimensions
-        self.ifmap_op_mat = np.random.rand(self.arr_row, self.arr_col)
-        self.ofmap_op_mat = np.zeros((self.arr_row, self.arr_col, 3))  # Assuming 3 output channels
-        self.filter_op_mat = np.random.rand(3, self.arr_row, self.arr_col)  # Adjust based on your model
+        # Operand matrices (addresses), set by set_params
+        self.ifmap_op_mat = np.zeros((1, 1), dtype=np.int64)
+        self.filter_op_mat = np.zeros((1, 1), dtype=np.int64)
+        self.ofmap_op_mat = np.zeros((1, 1), dtype=np.int64)
 
         # Derived parameters
-        self.Sr = self.ifmap_op_mat.shape[0]
-        self.Sc = self.filter_op_mat.shape[1]  # Assuming filter shape matches output channels
-        self.T = self.ifmap_op_mat.shape[1]
-
-        self.row_fold = math.ceil(self.Sr / self.arr_row)
-        self.col_fold = math.ceil(self.Sc / self.arr_col)
+        self.Sr = 0
+        self.Sc = 0
+        self.T = 0
+        self.row_fold = 0
+        self.col_fold = 0
+        self.num_folds = 0
+        self.fold_cycles = 0
 
         # Generated matrices
         self.ifmap_prefetch_matrix = np.zeros((1, 1))
         self.filter_prefetch_matrix = np.zeros((1, 1))
+        self.ifmap_demand_matrix = np.zeros((1, 1))
+        self.filter_demand_matrix = np.zeros((1, 1))
+        self.ofmap_demand_matrix = np.zeros((1, 1))
+
+        # Cambricon-D multiplier split of the last compute_conv2d
+        self.num_int_macs = 0  # Inliers on the int-fp multipliers
+        self.num_fp_macs = 0  # Outliers on the fp-fp multipliers
+        self.num_saturated_macs = 0  # Outliers beyond num_multiplier_fpfp, saturated
 
         # Flags
-        self.params_set_flag = True
+        self.params_set_flag = False
         self.prefetch_mat_ready_flag = False
+        self.demand_mat_ready_flag = False
 
     def set_params(self, ifmap_op_mat=None, ofmap_op_mat=None, filter_op_mat=None):
         # Check if matrices are provided and set them
         if ifmap_op_mat is not None:
-            self.ifmap_op_mat = ifmap_op_mat
+            self.ifmap_op_mat = np.asarray(ifmap_op_mat)
         if ofmap_op_mat is not None:
-            self.ofmap_op_mat = ofmap_op_mat
+            self.ofmap_op_mat = np.asarray(ofmap_op_mat)
         if filter_op_mat is not None:
-            self.filter_op_mat = filter_op_mat
+            self.filter_op_mat = np.asarray(filter_op_mat)
 
-        # Assume dimensions are derived from these matrices
+        # Dimensions are derived from these matrices
         self.Sr = self.ifmap_op_mat.shape[0]
         self.Sc = self.filter_op_mat.shape[1]
         self.T = self.ifmap_op_mat.shape[1]
+        if self.filter_op_mat.shape[0] != self.T or self.ofmap_op_mat.shape != (self.Sr, self.Sc):
+            raise ValueError(f"Operand matrices do not match: ifmap {self.ifmap_op_mat.shape}, "
+                             f"filter {self.filter_op_mat.shape}, ofmap {self.ofmap_op_mat.shape}.")
         self.arr_row, self.arr_col = self.config.get_array_dims()
 
-        # Other initializations based on new parameters
-        self.prepare_matrices()
+        self.row_fold = math.ceil(self.Sr / self.arr_row)
+        self.col_fold = math.ceil(self.Sc / self.arr_col)
+        self.num_folds = self.row_fold * self.col_fold
+        # T operand cycles plus the skew across the array rows and columns
+        self.fold_cycles = self.T + self.arr_row + self.arr_col - 2
+
+        self.params_set_flag = True
+        self.prefetch_mat_ready_flag = False
+        self.demand_mat_ready_flag = False
 
     def quantize_activations(self, activations):
-        quantized_activations = []
-        overflow_flags = []
-        for activation in activations:
-            if abs(activation) > self.quantization_threshold:
-                quantized_activations.append(activation)  # Keep as floating point
-                overflow_flags.append(True)
-            else:
-                quantized_activations.append(int(activation))  # Quantize to integer
-                overflow_flags.append(False)
-        return np.array(quantized_activations), overflow_flags
-
-    def multiplier_group(self, quantized_activations, weights, overflow_flags):
-        result = 0
-        outlier_count = 0
-        for i in range(min(len(quantized_activations), len(weights))):  # Ensure no out-of-bounds error
-            if not overflow_flags[i]:
-                result += quantized_activations[i] * weights[i]
-            else:
-                if outlier_count < self.num_multiplier_fpfp:
-                    result += quantized_activations[i] * weights[i]
-                    outlier_count += 1
-                else:
-                    max_val = 2**31 - 1
-                    min_val = -2**31
-                    result += (max_val if quantized_activations[i] > 0 else min_val) * weights[i]
-        return result
-
-    def compute_conv2d(self):
+        """Quantizes an activation array of any shape; returns the quantized values and the outlier mask."""
+        activations = np.asarray(activations, dtype=np.float64)
+        overflow_flags = np.abs(activations) > self.quantization_threshold
+        quantized_activations = np.where(overflow_flags, activations, np.trunc(activations) + 0.0)
+        return quantized_activations, overflow_flags
+
+    def multiplier_operands(self, quantized_activations, overflow_flags):
+        """
+        Effective activations of the multiplier group along the last axis: inliers
+        and the first num_multiplier_fpfp outliers keep their value, later outliers
+        saturate to the int range.
+        """
+        within_budget = np.cumsum(overflow_flags, axis=-1) <= self.num_multiplier_fpfp
+        saturated = overflow_flags & ~within_budget
+        max_val = 2**31 - 1
+        min_val = -2**31
+        operands = np.where(saturated, np.where(quantized_activations > 0, max_val, min_val), quantized_activations)
+        return operands, saturated
+
+    def compute_conv2d(self, ifmap_values, filter_values):
+        """
+        Computes the (Sr x Sc) ofmap of (Sr x T) ifmap and (T x Sc) filter values
+        laid out like the operand matrices, with the inlier/outlier split of the
+        Cambricon-D multiplier groups.
+        """
         if not self.params_set_flag:
             raise Exception("Parameters not set")
-        if not self.prefetch_mat_ready_flag:
-            self.create_prefetch_matrices()
+        ifmap_values = np.asarray(ifmap_values, dtype=np.float64)
+        filter_values = np.asarray(filter_values, dtype=np.float64)
+        if ifmap_values.shape != (self.Sr, self.T) or filter_values.shape != (self.T, self.Sc):
+            raise ValueError(f"Value matrices {ifmap_values.shape} and {filter_values.shape} do not match the "
+                             f"operand matrices ({self.Sr}, {self.T}) and ({self.T}, {self.Sc}).")
+
+        quantized_activations, overflow_flags = self.quantize_activations(ifmap_values)
+        operands, saturated = self.multiplier_operands(quantized_activations, overflow_flags)
 
-        Hout, Wout, Cout = self.ofmap_op_mat.shape[0], self.ofmap_op_mat.shape[1], self.filter_op_mat.shape[0]
-        output = np.zeros((Hout, Wout, Cout))
-        for d1 in range(Hout * Wout):
-            out_h = d1 // Wout
-            out_w = d1 % Wout
-            for d2 in range(Cout):
-                if d2 >= self.filter_prefetch_matrix.shape[0]:
-                    continue  # Skip if the index exceeds the available filter matrices
-                input_tile = self.ifmap_prefetch_matrix[:, d1].flatten() if d1 < self.ifmap_prefetch_matrix.shape[1] else np.zeros_like(self.ifmap_op_mat.flatten())
-                weights_for_d2 = self.filter_prefetch_matrix[d2, :].flatten()
-                quantized_activations, overflow_flags = self.quantize_activations(input_tile)
-                result = self.multiplier_group(quantized_activations, weights_for_d2, overflow_flags)
-                output[out_h, out_w, d2] = result
-        return output
+        # Every activation meets all Sc filters
+        num_outliers = int(overflow_flags.sum())
+        num_saturated = int(saturated.sum())
+        self.num_int_macs = (ifmap_values.size - num_outliers) * self.Sc
+        self.num_fp_macs = (num_outliers - num_saturated) * self.Sc
+        self.num_saturated_macs = num_saturated * self.Sc
+
+        return operands @ filter_values
+
+    def _fold_blocks(self):
+        """Per-fold (T x arr_row) ifmap, (T x arr_col) filter and (arr_row x arr_col) ofmap address blocks."""
+        ifmap = np.full((self.row_fold * self.arr_row, self.T), -1, dtype=self.ifmap_op_mat.dtype)
+        ifmap[:self.Sr] = self.ifmap_op_mat
+        filt = np.full((self.T, self.col_fold * self.arr_col), -1, dtype=self.filter_op_mat.dtype)
+        filt[:, :self.Sc] = self.filter_op_mat
+        ofmap = np.full((self.row_fold * self.arr_row, self.col_fold * self.arr_col), -1, dtype=self.ofmap_op_mat.dtype)
+        ofmap[:self.Sr, :self.Sc] = self.ofmap_op_mat
+
+        ifmap_blocks = ifmap.reshape(self.row_fold, self.arr_row, self.T).transpose(0, 2, 1)
+        filter_blocks = filt.reshape(self.T, self.col_fold, self.arr_col).transpose(1, 0, 2)
+        ofmap_blocks = ofmap.reshape(self.row_fold, self.arr_row, self.col_fold, self.arr_col).transpose(2, 0, 1, 3)
+        return ifmap_blocks, filter_blocks, ofmap_blocks.reshape(self.num_folds, self.arr_row, self.arr_col)
 
     def create_prefetch_matrices(self):
-        # Placeholder for actual matrix creation logic
+        """
+        The operands each fold brings in, one line per cycle without skew: the
+        ifmap rows of every row fold and the filter columns of every column fold.
+        """
+        if not self.params_set_flag:
+            raise Exception("Parameters not set")
+        ifmap_blocks, filter_blocks, _ = self._fold_blocks()
+        self.ifmap_prefetch_matrix = ifmap_blocks.reshape(-1, self.arr_row)
+        self.filter_prefetch_matrix = filter_blocks.reshape(-1, self.arr_col)
         self.prefetch_mat_ready_flag = True
 
-# Example usage
-config = scale_config()
-scos = systolic_compute_os(config)
-output = scos.compute_conv2d()
-print(output)
+    def _skewed(self, blocks, lanes):
+        """Places (num_folds x T x lanes) operands in fold_cycles-long folds, lane l delayed by l cycles."""
+        demand = np.full((blocks.shape[0], self.fold_cycles, lanes), -1, dtype=blocks.dtype)
+        k = np.arange(self.T)[:, None]
+        lane = np.arange(lanes)[None, :]
+        demand[:, k + lane, lane] = blocks
+        return demand.reshape(-1, lanes)
+
+    def create_demand_matrices(self):
+        """
+        Per-cycle demand of the whole layer, folds back to back. Array row r reads
+        ifmap operand k of its output pixel at cycle k + r of the fold, column c
+        filter operand k at cycle k + c, and PE (r, c) writes its output at cycle
+        T - 1 + r + c, when its last product arrives.
+        """
+        if not self.params_set_flag:
+            raise Exception("Parameters not set")
+        ifmap_blocks, filter_blocks, ofmap_blocks = self._fold_blocks()
+
+        # Fold f is column fold f // row_fold and row fold f % row_fold
+        self.ifmap_demand_matrix = self._skewed(np.tile(ifmap_blocks, (self.col_fold, 1, 1)), self.arr_row)
+        self.filter_demand_matrix = self._skewed(np.repeat(filter_blocks, self.row_fold, axis=0), self.arr_col)
+
+        ofmap_demand = np.full((self.num_folds, self.fold_cycles, self.arr_col), -1, dtype=ofmap_blocks.dtype)
+        r = np.arange(self.arr_row)[:, None]
+        c = np.arange(self.arr_col)[None, :]
+        ofmap_demand[:, self.T - 1 + r + c, c] = ofmap_blocks
+        self.ofmap_demand_matrix = ofmap_demand.reshape(-1, self.arr_col)
+        self.demand_mat_ready_flag = True
+
+    def get_prefetch_matrices(self):
+        if not self.prefetch_mat_ready_flag:
+            self.create_prefetch_matrices()
+        return self.ifmap_prefetch_matrix, self.filter_prefetch_matrix
+
+    def get_demand_matrices(self):
+        if not self.demand_mat_ready_flag:
+            self.create_demand_matrices()
+        return self.ifmap_demand_matrix, self.filter_demand_matrix, self.ofmap_demand_matrix
+
+    def _fold_utilization(self):
+        """Fraction of the PEs each fold maps an output to."""
+        rows = np.minimum(self.Sr - np.arange(self.row_fold) * self.arr_row, self.arr_row)
+        cols = np.minimum(self.Sc - np.arange(self.col_fold) * self.arr_col, self.arr_col)
+        return (cols[:, None] * rows[None, :]).ravel() / (self.arr_row * self.arr_col)
+
+    def get_total_cycles(self):
+        return self.num_folds * self.fold_cycles
+
+    def get_num_compute(self):
+        return self.Sr * self.Sc * self.T
+
+    def get_avg_mapping_efficiency(self):
+        return float(self._fold_utilization().mean())
+
+    def get_avg_compute_utilization(self):
+        # Mapped PEs only compute during the T operand cycles of each fold
+        return float(self._fold_utilization().mean() * self.T / self.fold_cycles)
+
+    def get_ifmap_requests(self):
+        return int(np.count_nonzero(self.get_demand_matrices()[0] != -1))
+
+    def get_filter_requests(self):
+        return int(np.count_nonzero(self.get_demand_matrices()[1] != -1))
+
+    def get_ofmap_requests(self):
+        return int(np.count_nonzero(self.get_demand_matrices()[2] != -1))
+
+if __name__ == "__main__":
+    # Example usage: a 3x3, 64 -> 128 channel conv layer on 64x64 outputs
+    ifmap_op_mat, filter_op_mat, ofmap_op_mat = conv_operand_matrices(66, 66, 3, 3, 64, 128)
+    ifmap_values = np.random.normal(0, 0.25, ifmap_op_mat.shape)
+    filter_values = np.random.rand(*filter_op_mat.shape)
+    for dims in [(128, 128), (256, 256)]:
+        config = scale_config(*dims)
+        scos = systolic_compute_os(config)
+        scos.set_params(ifmap_op_mat=ifmap_op_mat, ofmap_op_mat=ofmap_op_mat, filter_op_mat=filter_op_mat)
+        ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat = scos.get_demand_matrices()
+        output = scos.compute_conv2d(ifmap_values, filter_values)
+        print(f"{dims[0]}x{dims[1]} array: {scos.row_fold}x{scos.col_fold} folds, {scos.get_total_cycles()} cycles, "
+              f"mapping efficiency {scos.get_avg_mapping_efficiency():.3f}, "
+              f"compute utilization {scos.get_avg_compute_utilization():.3f}")
+        print(f"  demand: {scos.get_ifmap_requests()} ifmap, {scos.get_filter_requests()} filter, "
+              f"{scos.get_ofmap_requests()} ofmap requests; MACs: {scos.num_int_macs} int, "
+              f"{scos.num_fp_macs} fp, {scos.num_saturated_macs} saturated")
@@ -0,0 +1,101 @@
+import math
+import numpy as np
+from systolic_compute_os import systolic_compute_os
+
+class systolic_compute_ws(systolic_compute_os):
+    """
+    Weight-stationary compute core. The (T x Sc) filter matrix is pinned to the
+    array in row folds of arr_row operands and column folds of arr_col filters
+    (column folds outermost); the Sr ifmap rows then stream through every fold
+    and each column emits one partial sum per ifmap row, so the ofmap is written
+    once per row fold. Prefetch and demand matrices, metrics and the Cambricon-D
+    compute follow the systolic_compute_os interface.
+    """
+    def set_params(self, ifmap_op_mat=None, ofmap_op_mat=None, filter_op_mat=None):
+        super().set_params(ifmap_op_mat=ifmap_op_mat, ofmap_op_mat=ofmap_op_mat, filter_op_mat=filter_op_mat)
+
+        # Reduction on the rows, the stationary operand's columns on the array columns
+        stationary, streaming, _ = self._roles()
+        self.row_fold = math.ceil(self.T / self.arr_row)
+        self.col_fold = math.ceil(stationary.shape[1] / self.arr_col)
+        self.num_folds = self.row_fold * self.col_fold
+        # Stationary fill, the streamed operands and the skew across the array
+        self.fold_cycles = 2 * self.arr_row + self.arr_col + streaming.shape[1] - 2
+
+    def _roles(self):
+        """(T x X) stationary operand, (T x Y) streamed operand and (Y x X) outputs."""
+        return self.filter_op_mat, self.ifmap_op_mat.T, self.ofmap_op_mat
+
+    def _assign_roles(self, stationary, streaming):
+        """Maps the stationary and streamed matrices back to (ifmap, filter)."""
+        return streaming, stationary
+
+    def _fold_blocks(self):
+        """Per-fold (arr_row x arr_col) stationary, (Y x arr_row) streamed and (Y x arr_col) output blocks."""
+        stationary, streaming, outputs = self._roles()
+        X, Y = stationary.shape[1], streaming.shape[1]
+        stat = np.full((self.row_fold * self.arr_row, self.col_fold * self.arr_col), -1, dtype=stationary.dtype)
+        stat[:self.T, :X] = stationary
+        stream = np.full((self.row_fold * self.arr_row, Y), -1, dtype=streaming.dtype)
+        stream[:self.T] = streaming
+        out = np.full((Y, self.col_fold * self.arr_col), -1, dtype=outputs.dtype)
+        out[:, :X] = outputs
+
+        stationary_blocks = stat.reshape(self.row_fold, self.arr_row, self.col_fold, self.arr_col).transpose(2, 0, 1, 3)
+        streaming_blocks = stream.reshape(self.row_fold, self.arr_row, Y).transpose(0, 2, 1)
+        output_blocks = out.reshape(Y, self.col_fold, self.arr_col).transpose(1, 0, 2)
+        return stationary_blocks.reshape(self.num_folds, self.arr_row, self.arr_col), streaming_blocks, output_blocks
+
+    def create_prefetch_matrices(self):
+        """
+        The stationary block of every fold and the streamed operands of every row
+        fold, one line per cycle without skew.
+        """
+        if not self.params_set_flag:
+            raise Exception("Parameters not set")
+        stationary_blocks, streaming_blocks, _ = self._fold_blocks()
+        self.ifmap_prefetch_matrix, self.filter_prefetch_matrix = self._assign_roles(
+            stationary_blocks.reshape(-1, self.arr_col), streaming_blocks.reshape(-1, self.arr_row))
+        self.prefetch_mat_ready_flag = True
+
+    def create_demand_matrices(self):
+        """
+        Per-cycle demand of the whole layer, folds back to back. A fold loads its
+        stationary block one array row per cycle, then array row r reads streamed
+        operand y at cycle arr_row + y + r and column c writes the partial sum of
+        output y at cycle 2 * arr_row - 1 + y + c, when it leaves the bottom row.
+        """
+        if not self.params_set_flag:
+            raise Exception("Parameters not set")
+        stationary_blocks, streaming_blocks, output_blocks = self._fold_blocks()
+        Y = streaming_blocks.shape[1]
+
+        stationary_demand = np.full((self.num_folds, self.fold_cycles, self.arr_col), -1, dtype=stationary_blocks.dtype)
+        stationary_demand[:, :self.arr_row] = stationary_blocks
+
+        # Fold f is column fold f // row_fold and row fold f % row_fold
+        streaming_demand = np.full((self.num_folds, self.fold_cycles, self.arr_row), -1, dtype=streaming_blocks.dtype)
+        y = np.arange(Y)[:, None]
+        r = np.arange(self.arr_row)[None, :]
+        streaming_demand[:, self.arr_row + y + r, r] = np.tile(streaming_blocks, (self.col_fold, 1, 1))
+
+        output_demand = np.full((self.num_folds, self.fold_cycles, self.arr_col), -1, dtype=output_blocks.dtype)
+        c = np.arange(self.arr_col)[None, :]
+        output_demand[:, 2 * self.arr_row - 1 + y + c, c] = np.repeat(output_blocks, self.row_fold, axis=0)
+
+        self.ifmap_demand_matrix, self.filter_demand_matrix = self._assign_roles(
+            stationary_demand.reshape(-1, self.arr_col), streaming_demand.reshape(-1, self.arr_row))
+        self.ofmap_demand_matrix = output_demand.reshape(-1, self.arr_col)
+        self.demand_mat_ready_flag = True
+
+    def _fold_utilization(self):
+        """Fraction of the PEs each fold pins a stationary operand to."""
+        stationary, _, _ = self._roles()
+        rows = np.minimum(self.T - np.arange(self.row_fold) * self.arr_row, self.arr_row)
+        cols = np.minimum(stationary.shape[1] - np.arange(self.col_fold) * self.arr_col, self.arr_col)
+        return (cols[:, None] * rows[None, :]).ravel() / (self.arr_row * self.arr_col)
+
+    def get_avg_compute_utilization(self):
+        # Pinned PEs only compute while the operands stream through
+        _, streaming, _ = self._roles()
+        return float(self._fold_utilization().mean() * streaming.shape[1] / self.fold_cycles)
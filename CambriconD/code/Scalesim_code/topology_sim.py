@@ -0,0 +1,233 @@
+#Multi-layer topology runner: every layer of a network through single_layer_sim
+import csv
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from single_layer_sim import single_layer_sim
+from systolic_compute_os import conv_operand_matrices, scale_config
+
+# Columns of a topology file: the ScaleSim layer columns, the layer type and how
+# many times the layer runs per denoising step (attention heads, CFG batch)
+TOPOLOGY_COLUMNS = ('Layer name', 'IFMAP Height', 'IFMAP Width', 'Filter Height', 'Filter Width',
+                    'Channels', 'Num Filter', 'Strides', 'Type', 'Count')
+LAYER_KEYS = ('name', 'ifmap_h', 'ifmap_w', 'filt_h', 'filt_w', 'channels', 'num_filters', 'stride', 'type', 'count')
+SHAPE_KEYS = ('ifmap_h', 'ifmap_w', 'filt_h', 'filt_w', 'channels', 'num_filters', 'stride')
+
+# Report items of single_layer_sim, in the order of its get_*_report_items
+COMPUTE_ITEMS = ('total_cycles', 'stall_cycles', 'overall_util', 'mapping_eff', 'compute_util')
+BANDWIDTH_ITEMS = ('avg_ifmap_sram_bw', 'avg_filter_sram_bw', 'avg_ofmap_sram_bw',
+                   'avg_ifmap_dram_bw', 'avg_filter_dram_bw', 'avg_ofmap_dram_bw')
+DETAIL_ITEMS = tuple(f'{operand}_{memory}_{item}'
+                     for memory in ('sram', 'dram')
+                     for operand, access in (('ifmap', 'reads'), ('filter', 'reads'), ('ofmap', 'writes'))
+                     for item in ('start_cycle', 'stop_cycle', access))
+
+# Accesses summed over the network, with the count of every layer
+ACCESS_ITEMS = tuple(item for item in DETAIL_ITEMS if item.endswith(('reads', 'writes')))
+
+
+def read_topology(path):
+    """
+    Reads a topology CSV file. Type and Count are optional, a layer without them
+    is a 'conv' layer that runs once.
+    """
+    layers = []
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            row = [field.strip() for field in row if field.strip()]
+            if not row:
+                continue
+            layer = {'name': row[0]}
+            layer.update(zip(SHAPE_KEYS, map(int, row[1:8])))
+            layer['type'] = row[8] if len(row) > 8 else 'conv'
+            layer['count'] = int(row[9]) if len(row) > 9 else 1
+            layers.append(layer)
+    return layers
+
+
+def write_topology(path, layers):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TOPOLOGY_COLUMNS)
+        for layer in layers:
+            writer.writerow([layer[key] for key in LAYER_KEYS])
+
+
+def _layer(name, layer_type, ifmap_h, ifmap_w, filt, channels, num_filters, stride=1, count=1):
+    return {'name': name, 'ifmap_h': ifmap_h, 'ifmap_w': ifmap_w, 'filt_h': filt, 'filt_w': filt,
+            'channels': channels, 'num_filters': num_filters, 'stride': stride, 'type': layer_type, 'count': count}
+
+
+def _conv3x3(name, layer_type, size, channels, num_filters, stride=1, batch=1):
+    # Padding of 1 on every side
+    return _layer(name, layer_type, size + 2, size + 2, 3, channels, num_filters, stride, batch)
+
+
+def _gemm(name, layer_type, M, K, N, count=1):
+    # (M x K) x (K x N) as a 1x1 convolution over M pixels
+    return _layer(name, layer_type, M, 1, 1, K, N, 1, count)
+
+
+def _res_block(name, size, in_channels, out_channels, batch):
+    layers = [_conv3x3(f'{name}_conv1', 'conv', size, in_channels, out_channels, batch=batch),
+              _conv3x3(f'{name}_conv2', 'conv', size, out_channels, out_channels, batch=batch)]
+    if in_channels != out_channels:
+        layers.append(_layer(f'{name}_skip', 'conv', size, size, 1, in_channels, out_channels, 1, batch))
+    return layers
+
+
+def _transformer_block(name, size, channels, heads, context_len, context_dim, batch):
+    tokens = size * size
+    d_head = channels // heads
+    layers = [_gemm(f'{name}_proj_in', 'attn_proj', tokens, channels, channels, batch)]
+    # Self-attention: q, k, v from the image tokens
+    layers += [_gemm(f'{name}_attn1_{proj}', 'attn_proj', tokens, channels, channels, batch) for proj in 'qkv']
+    layers += [_gemm(f'{name}_attn1_scores', 'attn_scores', tokens, d_head, tokens, heads * batch),
+               _gemm(f'{name}_attn1_values', 'attn_values', tokens, tokens, d_head, heads * batch),
+               _gemm(f'{name}_attn1_out', 'attn_proj', tokens, channels, channels, batch)]
+    # Cross-attention: k, v from the text context
+    layers += [_gemm(f'{name}_attn2_q', 'attn_proj', tokens, channels, channels, batch),
+               _gemm(f'{name}_attn2_k', 'attn_proj', context_len, context_dim, channels, batch),
+               _gemm(f'{name}_attn2_v', 'attn_proj', context_len, context_dim, channels, batch),
+               _gemm(f'{name}_attn2_scores', 'attn_scores', tokens, d_head, context_len, heads * batch),
+               _gemm(f'{name}_attn2_values', 'attn_values', tokens, context_len, d_head, heads * batch),
+               _gemm(f'{name}_attn2_out', 'attn_proj', tokens, channels, channels, batch)]
+    # GEGLU feed-forward and the output projection
+    layers += [_gemm(f'{name}_ff_in', 'ff', tokens, channels, 8 * channels, batch),
+               _gemm(f'{name}_ff_out', 'ff', tokens, 4 * channels, channels, batch),
+               _gemm(f'{name}_proj_out', 'attn_proj', tokens, channels, channels, batch)]
+    return layers
+
+
+def diffusion_unet_layers(latent_size=64, latent_channels=4, base_channels=320, channel_mults=(1, 2, 4, 4),
+                          attention_levels=(0, 1, 2), res_blocks=2, heads=8, context_len=77, context_dim=768,
+                          batch=2):
+    """
+    Layer table of one denoising step of a latent diffusion UNet (Stable
+    Diffusion 1.x by default, batch 2 for classifier-free guidance): the 3x3
+    convolutions of the residual blocks, the attention projections, scores and
+    values of the transformer blocks, their feed-forward layers and the
+    strided-conv downsamplers and nearest-upsample convolutions. Normalization,
+    softmax and the time embedding are not matrix work and are left out.
+    """
+    channels = [base_channels * mult for mult in channel_mults]
+    layers = [_conv3x3('conv_in', 'conv', latent_size, latent_channels, base_channels, batch=batch)]
+
+    # Encoder; skips holds the channels of every activation the decoder concatenates
+    size, current = latent_size, base_channels
+    skips = [current]
+    for level, level_channels in enumerate(channels):
+        for block in range(res_blocks):
+            name = f'down{level}_block{block}'
+            layers += _res_block(f'{name}_res', size, current, level_channels, batch)
+            current = level_channels
+            if level in attention_levels:
+                layers += _transformer_block(f'{name}_attn', size, current, heads, context_len, context_dim, batch)
+            skips.append(current)
+        if level < len(channels) - 1:
+            layers.append(_conv3x3(f'down{level}_downsample', 'downsample', size, current, current, 2, batch))
+            size //= 2
+            skips.append(current)
+
+    layers += _res_block('mid_res0', size, current, current, batch)
+    layers += _transformer_block('mid_attn', size, current, heads, context_len, context_dim, batch)
+    layers += _res_block('mid_res1', size, current, current, batch)
+
+    # Decoder, one more block per level to consume the skips
+    for level in reversed(range(len(channels))):
+        for block in range(res_blocks + 1):
+            name = f'up{level}_block{block}'
+            layers += _res_block(f'{name}_res', size, current + skips.pop(), channels[level], batch)
+            current = channels[level]
+            if level in attention_levels:
+                layers += _transformer_block(f'{name}_attn', size, current, heads, context_len, context_dim, batch)
+        if level > 0:
+            size *= 2
+            layers.append(_conv3x3(f'up{level}_upsample', 'upsample', size, current, current, batch=batch))
+
+    layers.append(_conv3x3('conv_out', 'conv', size, base_channels, latent_channels, batch=batch))
+    return layers
+
+
+def _simulate_shape(job):
+    """
+    Worker entry point: runs one layer shape through single_layer_sim. Returns
+    its compute, bandwidth and detail report items and the number of MACs.
+    """
+    shape, config_obj = job
+    layer_sim = single_layer_sim()
+    layer_sim.set_params(config_obj=config_obj, verbose=False,
+                         operand_matrices=conv_operand_matrices(*(shape[key] for key in SHAPE_KEYS)))
+    layer_sim.run()
+    report = dict(zip(COMPUTE_ITEMS, layer_sim.get_compute_report_items()))
+    report.update(zip(BANDWIDTH_ITEMS, layer_sim.get_bandwidth_report_items()))
+    report.update(zip(DETAIL_ITEMS, layer_sim.get_detail_report_items()))
+    report['num_compute'] = layer_sim.num_compute
+    return report
+
+
+def run_topology(layers, config_obj, max_workers=None):
+    """
+    Simulates every layer of a topology on a process pool. Layers are
+    independent, and layers of the same shape are simulated once. Returns one
+    report per layer, in table order, and the network totals of one denoising
+    step (see network_totals).
+    """
+    shapes = list(dict.fromkeys(tuple(layer[key] for key in SHAPE_KEYS) for layer in layers))
+    jobs = [(dict(zip(SHAPE_KEYS, shape)), config_obj) for shape in shapes]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        shape_reports = dict(zip(shapes, executor.map(_simulate_shape, jobs)))
+
+    layer_reports = []
+    for layer in layers:
+        report = {'name': layer['name'], 'type': layer['type'], 'count': layer['count']}
+        report.update(shape_reports[tuple(layer[key] for key in SHAPE_KEYS)])
+        layer_reports.append(report)
+    return layer_reports, network_totals(layer_reports, config_obj)
+
+
+def network_totals(layer_reports, config_obj):
+    """
+    Network totals of one denoising step. The layers run back to back on the
+    array, each as many times as its count, so the step latency is the sum of
+    their cycles; bandwidths are averaged over the step and the accesses summed.
+    The cycles per layer type are reported under 'cycles_by_type'.
+    """
+    array_rows, array_cols = config_obj.get_array_dims()
+    totals = {'layers': sum(report['count'] for report in layer_reports)}
+    for item in ('total_cycles', 'stall_cycles', 'num_compute') + ACCESS_ITEMS:
+        totals[item] = sum(report[item] * report['count'] for report in layer_reports)
+    cycles = totals['total_cycles']
+    totals['overall_util'] = totals['num_compute'] * 100 / (cycles * array_rows * array_cols) if cycles else 0
+    for memory in ('sram', 'dram'):
+        for operand, access in (('ifmap', 'reads'), ('filter', 'reads'), ('ofmap', 'writes')):
+            totals[f'avg_{operand}_{memory}_bw'] = totals[f'{operand}_{memory}_{access}'] / cycles if cycles else 0
+
+    totals['cycles_by_type'] = {}
+    for report in layer_reports:
+        by_type = totals['cycles_by_type']
+        by_type[report['type']] = by_type.get(report['type'], 0) + report['total_cycles'] * report['count']
+    return totals
+
+
+def print_network_report(totals):
+    print(f"Layers per denoising step: {totals['layers']}")
+    print(f"Latency per denoising step: {totals['total_cycles']} cycles ({totals['stall_cycles']} stall)")
+    print(f"Overall utilization: {totals['overall_util']:.2f}%")
+    for memory in ('sram', 'dram'):
+        bandwidths = ', '.join(f"{operand} {totals[f'avg_{operand}_{memory}_bw']:.2f}"
+                               for operand in ('ifmap', 'filter', 'ofmap'))
+        print(f"Average {memory.upper()} bandwidth (words/cycle): {bandwidths}")
+    print("Cycles by layer type:")
+    for layer_type, cycles in sorted(totals['cycles_by_type'].items(), key=lambda item: -item[1]):
+        print(f"  {layer_type}: {cycles} ({cycles * 100 / totals['total_cycles']:.1f}%)")
+
+
+if __name__ == "__main__":
+    # A topology file on the command line, the Stable Diffusion UNet otherwise
+    layers = read_topology(sys.argv[1]) if len(sys.argv) > 1 else diffusion_unet_layers()
+    config = scale_config(array_rows=128, array_cols=128, dataflow='os')
+    _, totals = run_topology(layers, config)
+    print_network_report(totals)
@@ -0,0 +1,146 @@
+#Chunked binary SRAM traces: compressed .npz (or memory-mappable .npy) chunks and an index
+import json
+import os
+import zipfile
+import numpy as np
+
+INDEX_FILE = 'index.json'
+DEFAULT_CHUNK_ROWS = 1 << 16
+# Deflate level of the .npz chunks; the mostly -1 demand rows compress about as
+# well at level 1 as at numpy's default level 6, several times faster
+COMPRESS_LEVEL = 1
+
+
+def address_dtype(demand_mat):
+    """Smallest signed type holding every address of a demand matrix and the -1 padding."""
+    max_address = int(demand_mat.max()) if demand_mat.size else 0
+    for dtype in (np.int16, np.int32):
+        if max_address <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _savez(filename, **arrays):
+    # np.savez_compressed with COMPRESS_LEVEL instead of the zlib default
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+        for name, array in arrays.items():
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asarray(array))
+
+
+class trace_writer:
+    """
+    Writes a trace to a directory of chunks: every chunk holds the serviced
+    cycles of chunk_rows demand rows and the (rows x lanes) addresses requested
+    in them (-1 for none). Chunks are compressed .npz files, or a pair of .npy
+    files when compress is False so the reader can memory-map them. Chunks are
+    written as they are appended; close() writes the index.
+    """
+    def __init__(self, path, lanes, chunk_rows=DEFAULT_CHUNK_ROWS, compress=True, dtype=np.int32):
+        self.path = path
+        self.lanes = lanes
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.dtype = np.dtype(dtype)
+        self.chunk_sizes = []
+        self._cycles = []
+        self._demand = []
+        self._pending = 0
+        self.closed = False
+        os.makedirs(self.path, exist_ok=True)
+
+    def append(self, cycles, demand_rows):
+        """Appends demand rows and the cycles they are serviced at; full chunks are written out."""
+        assert not self.closed, 'Trace writer is closed'
+        demand_rows = np.asarray(demand_rows)
+        if demand_rows.ndim != 2 or demand_rows.shape[1] != self.lanes:
+            raise ValueError(f"Expected (rows x {self.lanes}) demand rows, got {demand_rows.shape}.")
+        self._cycles.append(np.asarray(cycles, dtype=np.int64))
+        self._demand.append(demand_rows.astype(self.dtype, copy=False))
+        self._pending += demand_rows.shape[0]
+        while self._pending >= self.chunk_rows:
+            self._flush(self.chunk_rows)
+
+    def _flush(self, rows):
+        cycles = np.concatenate(self._cycles)
+        demand = np.concatenate(self._demand)
+        self._cycles, self._demand = [cycles[rows:]], [demand[rows:]]
+        self._pending -= rows
+
+        name = os.path.join(self.path, f'chunk_{len(self.chunk_sizes):05d}')
+        if self.compress:
+            _savez(name + '.npz', cycles=cycles[:rows], demand=demand[:rows])
+        else:
+            np.save(name + '_cycles.npy', cycles[:rows])
+            np.save(name + '_demand.npy', demand[:rows])
+        self.chunk_sizes.append(rows)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._pending:
+            self._flush(self._pending)
+        index = {'lanes': self.lanes, 'dtype': self.dtype.name, 'compress': self.compress,
+                 'chunk_sizes': self.chunk_sizes}
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_trace(path, cycles, demand_mat, chunk_rows=DEFAULT_CHUNK_ROWS, compress=True):
+    """Writes a whole demand matrix and its serviced cycles as a chunked trace."""
+    demand_mat = np.asarray(demand_mat)
+    with trace_writer(path, demand_mat.shape[1], chunk_rows, compress, address_dtype(demand_mat)) as writer:
+        for start in range(0, demand_mat.shape[0], chunk_rows):
+            writer.append(cycles[start:start + chunk_rows], demand_mat[start:start + chunk_rows])
+
+
+class trace_reader:
+    """
+    Reads a trace written by trace_writer, one chunk at a time or whole.
+    Uncompressed traces can be memory-mapped.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.lanes = index['lanes']
+        self.dtype = np.dtype(index['dtype'])
+        self.compress = index['compress']
+        self.chunk_sizes = index['chunk_sizes']
+        self.num_rows = sum(self.chunk_sizes)
+        self.num_chunks = len(self.chunk_sizes)
+
+    def chunk(self, i, mmap=False):
+        """(cycles, demand) of chunk i; with mmap the arrays are memory-mapped (uncompressed traces only)."""
+        name = os.path.join(self.path, f'chunk_{i:05d}')
+        if self.compress:
+            if mmap:
+                raise ValueError("Compressed traces cannot be memory-mapped.")
+            with np.load(name + '.npz') as data:
+                return data['cycles'], data['demand']
+        mmap_mode = 'r' if mmap else None
+        return np.load(name + '_cycles.npy', mmap_mode=mmap_mode), np.load(name + '_demand.npy', mmap_mode=mmap_mode)
+
+    def __iter__(self):
+        for i in range(self.num_chunks):
+            yield self.chunk(i)
+
+    def read(self):
+        """The whole trace as (cycles, demand)."""
+        if not self.num_chunks:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.lanes), dtype=self.dtype)
+        cycles, demand = zip(*self)
+        return np.concatenate(cycles), np.concatenate(demand)
+
+    def to_csv(self, filename):
+        """Writes the trace in the CSV layout of the scratchpad's print_*_sram_trace."""
+        with open(filename, 'w') as f:
+            for cycles, demand in self:
+                np.savetxt(f, np.concatenate((cycles[:, None], demand), axis=1), fmt='%d', delimiter=',')
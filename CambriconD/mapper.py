@@ -0,0 +1,161 @@
+import itertools
+import math
+
+# Loops of the convolution nest: d1 over output locations (N*Hout*Wout),
+# d2 over output channels (Cout) and d3 over the reduction (Kh*Kw*Cin)
+LOOP_DIMS = ("d1", "d2", "d3")
+
+# Loops that index each operand tile
+OPERAND_DIMS = {
+    "input": ("d1", "d3"),
+    "weight": ("d2", "d3"),
+    "output": ("d1", "d2"),
+}
+
+# Bytes per element of the InputBuf (uint8), WeightBuf (int8) and OutputBuf (int32)
+ELEMENT_BYTES = {"input": 1, "weight": 1, "output": 4}
+
+# On-chip capacity available to the resident tile of each operand
+BUFFER_BYTES = {"input": 64 * 1024, "weight": 64 * 1024, "output": 128 * 1024}
+
+
+def conv_loop_bounds(N, Hout, Wout, Cin, Cout, Kh, Kw):
+    """
+    Trip counts of the d1, d2 and d3 loops of a convolution layer.
+    """
+    return {"d1": N * Hout * Wout, "d2": Cout, "d3": Kh * Kw * Cin}
+
+
+def candidate_tile_sizes(bound, limit):
+    """
+    Tile sizes tried for one loop: the powers of two below min(bound, limit)
+    and min(bound, limit) itself.
+    """
+    largest = min(bound, limit)
+    sizes = {largest}
+    size = 1
+    while size < largest:
+        sizes.add(size)
+        size *= 2
+    return sorted(sizes)
+
+
+def default_mapping(bounds, PE_rows=128, PE_cols=128):
+    """
+    The hard-coded mapping of CambriconDSimulator: d1, d2, d3 from outermost to
+    innermost, with d1 tiled by the PE rows and d2 and d3 by the PE columns.
+    """
+    tiles = {"d1": min(bounds["d1"], PE_rows), "d2": min(bounds["d2"], PE_cols), "d3": min(bounds["d3"], PE_cols)}
+    return {"loop_order": LOOP_DIMS, "tiles": tiles}
+
+
+def score_mapping(bounds, loop_order, tiles, macs_per_pe=1, element_bytes=ELEMENT_BYTES, bytes_per_cycle=1500,
+                  PE_rows=128, PE_cols=128):
+    """
+    Analytical cost of one mapping.
+
+    The PE array holds a tiles["d1"] x tiles["d2"] block of outputs and every PE
+    reduces tiles["d3"] products per tile at macs_per_pe per cycle. An operand
+    tile stays on chip while the loops inside the innermost loop that indexes it
+    run, and is fetched again on every iteration of that loop or of a loop
+    outside it. Outputs fetched again are partial sums: they are read back and
+    written once more. The buffer traffic overlaps with compute at
+    bytes_per_cycle. pe_utilization is the mean fraction of the PE_rows x
+    PE_cols array holding an output over the tile steps. Returns the mapping
+    with its compute cycles, cycles, traffic (elements per operand),
+    traffic_bytes and pe_utilization.
+    """
+    trips = {dim: math.ceil(bounds[dim] / tiles[dim]) for dim in LOOP_DIMS}
+    compute_cycles = math.prod(trips.values()) * math.ceil(tiles["d3"] / macs_per_pe)
+
+    traffic = {}
+    for operand, dims in OPERAND_DIMS.items():
+        innermost = max(loop_order.index(dim) for dim in dims)
+        fetches = math.prod(trips[dim] for dim in loop_order[:innermost + 1])
+        footprint = tiles[dims[0]] * tiles[dims[1]]
+        if operand == "output":
+            # Every fetch ends in a write; all but the first visit of a tile also read it back
+            distinct_tiles = trips["d1"] * trips["d2"]
+            traffic["output"] = (2 * fetches - distinct_tiles) * footprint
+        else:
+            traffic[operand] = fetches * footprint
+
+    traffic_bytes = sum(traffic[operand] * element_bytes[operand] for operand in traffic)
+    cycles = max(compute_cycles, math.ceil(traffic_bytes / bytes_per_cycle))
+    pe_utilization = bounds["d1"] * bounds["d2"] / (trips["d1"] * trips["d2"] * PE_rows * PE_cols)
+    return {
+        "loop_order": tuple(loop_order),
+        "tiles": dict(tiles),
+        "compute_cycles": compute_cycles,
+        "cycles": cycles,
+        "traffic": traffic,
+        "traffic_bytes": traffic_bytes,
+        "pe_utilization": pe_utilization,
+    }
+
+
+def enumerate_mappings(bounds, PE_rows=128, PE_cols=128, macs_per_pe=1, buffer_bytes=BUFFER_BYTES,
+                       element_bytes=ELEMENT_BYTES, bytes_per_cycle=1500):
+    """
+    Yield every legal mapping of the loop nest with its score. A mapping is a
+    permutation of the d1, d2, d3 loops and a tile size per loop; it is legal if
+    the d1 tile fits the PE rows, the d2 tile fits the PE columns and the resident
+    tile of every operand fits its buffer.
+    """
+    limits = {"d1": PE_rows, "d2": PE_cols, "d3": bounds["d3"]}
+    tile_sizes = [candidate_tile_sizes(bounds[dim], limits[dim]) for dim in LOOP_DIMS]
+    for sizes in itertools.product(*tile_sizes):
+        tiles = dict(zip(LOOP_DIMS, sizes))
+        if any(tiles[dims[0]] * tiles[dims[1]] * element_bytes[operand] > buffer_bytes[operand]
+               for operand, dims in OPERAND_DIMS.items()):
+            continue
+        for loop_order in itertools.permutations(LOOP_DIMS):
+            yield score_mapping(bounds, loop_order, tiles, macs_per_pe, element_bytes, bytes_per_cycle,
+                                PE_rows, PE_cols)
+
+
+def best_mapping(bounds, **hardware):
+    """
+    The legal mapping with the fewest cycles, ties broken by buffer traffic,
+    then by the highest PE utilization, so an equally fast tiling that leaves
+    most of the array idle is not picked. Any remaining tie goes to the first
+    mapping in enumeration order. hardware is passed on to enumerate_mappings.
+    """
+    return min(enumerate_mappings(bounds, **hardware),
+               key=lambda mapping: (mapping["cycles"], mapping["traffic_bytes"], -mapping["pe_utilization"]))
+
+
+def tile_loop_nest(mapping, bounds):
+    """
+    Walk the tiled loop nest of a mapping in its loop order. Yields one dict per
+    tile step mapping each loop to the slice of its range covered by the tile.
+    """
+    loop_order = mapping["loop_order"]
+    starts = [range(0, bounds[dim], mapping["tiles"][dim]) for dim in loop_order]
+    for step in itertools.product(*starts):
+        yield {dim: slice(start, min(start + mapping["tiles"][dim], bounds[dim]))
+               for dim, start in zip(loop_order, step)}
+
+
+def print_mapping(mapping):
+    """
+    Print a mapping and its score.
+    """
+    order = " > ".join(mapping["loop_order"])
+    tiles = ", ".join(f"{dim}={mapping['tiles'][dim]}" for dim in LOOP_DIMS)
+    print(f"Loop order (outer to inner): {order}")
+    print(f"Tile sizes: {tiles}")
+    if "cycles" in mapping:
+        print(f"Cycles: {mapping['cycles']} (compute {mapping['compute_cycles']}), "
+              f"PE utilization {mapping['pe_utilization']:.3f}")
+        traffic = ", ".join(f"{operand} {elements}" for operand, elements in mapping["traffic"].items())
+        print(f"Buffer traffic: {mapping['traffic_bytes']} bytes ({traffic} elements)")
+
+
+if __name__ == "__main__":
+    bounds = conv_loop_bounds(N=32, Hout=64, Wout=64, Cin=3, Cout=64, Kh=3, Kw=3)
+    print("Default mapping:")
+    default = default_mapping(bounds)
+    print_mapping(score_mapping(bounds, default["loop_order"], default["tiles"]))
+    print("\nBest mapping:")
+    print_mapping(best_mapping(bounds))
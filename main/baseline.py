@@ -1,6 +1,9 @@
 #Systolic Array Simulation Prototype
 import numpy as np
 
+from memory_hierarchy import MemoryHierarchy
+from roofline import roofline
+
 # Constants for GUID models
 CLOCK_SPEED_GHZ = 1  # Clock speed in GHz
 MEMORY_BANDWIDTH_TBPS = 1.5  # Memory bandwidth in TB/s
@@ -8,49 +11,118 @@ MEMORY_BANDWIDTH_BPS = MEMORY_BANDWIDTH_TBPS * 1e12  # Convert to bytes per seco
 CLOCK_CYCLE_TIME_NS = 1 / CLOCK_SPEED_GHZ  # Time per clock cycle in nanoseconds
 
 class SystolicArraySimulator:
-    def __init__(self, array_dim):
+    def __init__(self, array_dim, overlap_folds=True, memory=None, loop_order="mn"):
         self.PE_ARRAY_DIM = array_dim  # Dimension of PE array (NxN)
+        self.overlap_folds = overlap_folds  # Drain a fold while the next one computes
+        self.memory = memory if memory is not None else MemoryHierarchy()  # SRAM buffers and DRAM
+        self.loop_order = loop_order  # Order of the row/column folds
         self.NUM_PES = self.PE_ARRAY_DIM ** 2  # Total number of PEs
         self.total_cycles = 0
         self.memory_access_cycles = 0
         self.compute_cycles = 0
         self.memory_access_time = 0
+        self.stall_cycles = 0
+        self.roofline = {}  # Roofline results of the last memory_access
+        self.memory_accesses = {}  # SRAM and DRAM accesses of the last memory_access
+        self.gemm_shape = (0, 0, 0)  # (M, K, N) of the last compute
+        self.row_folds = 0
+        self.col_folds = 0
+        self.fold_cycles = np.zeros((0, 0), dtype=np.int64)  # Fill + compute + drain cycles of each fold
+        self.fold_start_cycles = np.zeros((0, 0), dtype=np.int64)  # Cycle each fold starts streaming operands
+        self.mapping_efficiency = 0
+
+    def fold_shapes(self, num_rows, num_cols):
+        """
+        Rows and columns of the PE array used by each row fold and column fold when
+        an output of num_rows x num_cols is tiled onto the array. The last fold in
+        each direction is partial when the size is not a multiple of PE_ARRAY_DIM.
+        """
+        fold_rows = np.minimum(self.PE_ARRAY_DIM, num_rows - np.arange(0, num_rows, self.PE_ARRAY_DIM))
+        fold_cols = np.minimum(self.PE_ARRAY_DIM, num_cols - np.arange(0, num_cols, self.PE_ARRAY_DIM))
+        return fold_rows, fold_cols
+
+    def os_fold_timing(self, fold_rows, fold_cols, K):
+        """
+        Output-stationary timing of every fold, in row-major fold order. Operands
+        enter the array skewed by one cycle per row/column, so a fold of r x c PEs
+        needs (r - 1) + (c - 1) fill cycles before its last PE has all K operand
+        pairs, and r cycles to shift its outputs out. With overlap_folds, the next
+        fold streams in right behind the current one (every K cycles) while the
+        finished outputs drain, waiting only if the drain takes longer than K.
+        Returns (fold_cycles, fold_start_cycles, total_cycles).
+        """
+        rows = np.broadcast_to(np.asarray(fold_rows, dtype=np.int64)[:, None], (len(fold_rows), len(fold_cols))).ravel()
+        cols = np.broadcast_to(np.asarray(fold_cols, dtype=np.int64)[None, :], (len(fold_rows), len(fold_cols))).ravel()
+
+        fill = (rows - 1) + (cols - 1)
+        drain = rows
+        fold_cycles = fill + K + drain
 
-    def compute(self, ifmap, filter_matrix):
+        # Cycles between the start of one fold and the start of the next
+        if self.overlap_folds:
+            issue_interval = np.maximum(K, drain)
+        else:
+            issue_interval = fold_cycles
+        fold_start_cycles = np.concatenate(([0], np.cumsum(issue_interval[:-1])))
+        # A partial trailing fold fills and drains faster, so an earlier fold can end last
+        total_cycles = int((fold_start_cycles + fold_cycles).max()) if len(fold_cycles) else 0
+
+        shape = (len(fold_rows), len(fold_cols))
+        return fold_cycles.reshape(shape), fold_start_cycles.reshape(shape), total_cycles
+
+    def compute(self, ifmap, filter_matrix, count_only=False):
         """
         Perform matrix multiplication using the systolic array.
+        The (M x K) ifmap times (K x N) filter product is tiled onto the PE array in
+        row folds of PE_ARRAY_DIM ifmap rows and column folds of PE_ARRAY_DIM filter
+        columns. Each fold is one block product; its cycles follow the
+        output-stationary timing of os_fold_timing, partial folds included.
+        With count_only=True only the cycles are counted and None is returned.
         """
-        MATRIX_DIM = ifmap.shape[0]  # Assume square matrices
-        self.compute_cycles = MATRIX_DIM * MATRIX_DIM  # Simplified cycle count
+        M, K = ifmap.shape
+        K_filter, N = filter_matrix.shape
+        if K != K_filter:
+            raise ValueError(f"Inner dimensions of ifmap ({K}) and filter matrix ({K_filter}) must match.")
+
+        fold_rows, fold_cols = self.fold_shapes(M, N)
+        self.row_folds, self.col_folds = len(fold_rows), len(fold_cols)
+        self.fold_cycles, self.fold_start_cycles, self.compute_cycles = self.os_fold_timing(fold_rows, fold_cols, K)
+        self.mapping_efficiency = (M * N) / (self.row_folds * self.col_folds * self.NUM_PES)
+        self.gemm_shape = (M, K, N)
+
         self.total_cycles += self.compute_cycles
+        if count_only:
+            return None
 
-        # Perform matrix multiplication
-        ofmap = np.zeros_like(ifmap)
-        for i in range(MATRIX_DIM):
-            for j in range(MATRIX_DIM):
-                for k in range(MATRIX_DIM):
-                    ofmap[i, j] += ifmap[i, k] * filter_matrix[k, j]
+        # Perform matrix multiplication one fold (block product) at a time
+        ofmap = np.zeros((M, N), dtype=np.result_type(ifmap, filter_matrix))
+        for row_start in range(0, M, self.PE_ARRAY_DIM):
+            rows = slice(row_start, row_start + self.PE_ARRAY_DIM)
+            for col_start in range(0, N, self.PE_ARRAY_DIM):
+                cols = slice(col_start, col_start + self.PE_ARRAY_DIM)
+                ofmap[rows, cols] = ifmap[rows, :] @ filter_matrix[:, cols]
 
         return ofmap
 
-    def memory_access(self, matrix_dim):
+    def memory_access(self):
         """
         Simulate memory access cycles for the operation.
+        The SRAM and DRAM accesses of the last compute come from the memory
+        hierarchy, given its folds and loop order. The DRAM traffic goes through
+        the roofline model: transfers overlap with compute and only the memory
+        time beyond the compute cycles stalls the array.
         """
-        # Calculate memory access time (read + write)
-        read_access_cycles = matrix_dim ** 2 * 2  # Two matrices to read
-        write_access_cycles = matrix_dim ** 2  # Output matrix to write
-        for i in range(40):
-            self.memory_access_cycles = read_access_cycles + write_access_cycles
-            self.total_cycles += self.memory_access_cycles
-        if matrix_dim==128:
-            self.memory_access_cycles=self.memory_access_cycles*8
-        else:
-            self.memory_access_cycles=self.memory_access_cycles*5
+        M, K, N = self.gemm_shape
+        self.memory_accesses = self.memory.gemm_accesses(M, K, N, self.PE_ARRAY_DIM, self.PE_ARRAY_DIM, self.loop_order)
+        operand_bytes = self.memory.dram_bytes(self.memory_accesses)
+        self.roofline = roofline(self.compute_cycles, operand_bytes, MEMORY_BANDWIDTH_BPS, CLOCK_SPEED_GHZ)
+
+        self.memory_access_cycles = self.roofline["memory_cycles"]
+        self.stall_cycles = self.roofline["stall_cycles"]
+        self.total_cycles += self.stall_cycles
 
         # Memory access time in nanoseconds
-        memory_access_time = (matrix_dim ** 2 * 2 * 8) / MEMORY_BANDWIDTH_BPS  # Convert to bytes
-        self.memory_access_time = memory_access_time * 1e9  # Convert to nanoseconds
+        self.memory_access_time = self.memory_access_cycles * CLOCK_CYCLE_TIME_NS
         return self.memory_access_time
 
     def get_results(self):
@@ -72,7 +144,7 @@ def run_simulation(array_dim, matrix_dim):
     ofmap = simulator.compute(ifmap, filter_matrix)
 
     # Simulate memory access
-    memory_access_time_ns = simulator.memory_access(matrix_dim)
+    memory_access_time_ns = simulator.memory_access()
 
     # Get cycles
     total_cycles, compute_cycles, memory_access_cycles = simulator.get_results()
@@ -84,11 +156,22 @@ def run_simulation(array_dim, matrix_dim):
     print(f"Total Memory Access Cycles: {memory_access_cycles}")
     print(f"Total Cycles for Simulation: {total_cycles}")
     print(f"Memory Access Time: {memory_access_time_ns:.2f} ns")
+    print(f"DRAM Accesses: {simulator.memory_accesses['ifmap_dram_reads']} ifmap, "
+          f"{simulator.memory_accesses['filter_dram_reads']} filter, {simulator.memory_accesses['ofmap_dram_writes']} ofmap")
+    print(f"Stall Cycles: {simulator.stall_cycles} ({simulator.roofline['bound']}-bound, "
+          f"achieved bandwidth {simulator.roofline['achieved_bandwidth_bps'] / 1e12:.3f} TB/s)")
     return total_cycles
 
 # Run for GUID 128 and GUID 512
-guid_128_cycles = run_simulation(array_dim=128, matrix_dim=128)
-guid_512_cycles = run_simulation(array_dim=512, matrix_dim=512)
+if __name__ == "__main__":
+    guid_128_cycles = run_simulation(array_dim=128, matrix_dim=128)
+    guid_512_cycles = run_simulation(array_dim=512, matrix_dim=512)
+
+    # The partial trailing row fold (1 of 4097 rows) ends before the full fold ahead of it
+    partial_fold_sim = SystolicArraySimulator(128)
+    partial_fold_sim.compute(np.zeros((4097, 27)), np.zeros((27, 128)), count_only=True)
+    fold_end_cycles = partial_fold_sim.fold_start_cycles + partial_fold_sim.fold_cycles
+    assert partial_fold_sim.compute_cycles == fold_end_cycles.max() > fold_end_cycles[-1, -1]
 
 
 
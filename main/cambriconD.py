@@ -1,22 +1,35 @@
+import math
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from memory_hierarchy import MemoryHierarchy
+from roofline import roofline
+
+# Clock and off-chip memory of the accelerator (same as the baseline)
+CLOCK_SPEED_GHZ = 1  # Clock speed in GHz
+MEMORY_BANDWIDTH_TBPS = 1.5  # Memory bandwidth in TB/s
+MEMORY_BANDWIDTH_BPS = MEMORY_BANDWIDTH_TBPS * 1e12  # Convert to bytes per second
+
+# On-chip SRAM buffers in front of the off-chip memory
+DEFAULT_MEMORY = MemoryHierarchy()
 
 # Simulate the quantization of input activations
 def quantize_activations(activations, quantization_threshold=0.5):
     """
     Quantize the input activations. Activations that overflow the threshold
     will be marked as outliers.
+
+    Works on an activation array of any shape in a single pass and returns the
+    quantized array (same shape, float) together with a boolean outlier mask.
     """
-    quantized_activations = []
-    overflow_flags = []
-    for activation in activations:
-        if abs(activation) > quantization_threshold:  # outlier
-            quantized_activations.append(activation)  # Keep as FP
-            overflow_flags.append(True)
-        else:  # inlier
-            quantized_activations.append(int(activation))  # Quantize to int
-            overflow_flags.append(False)
-    
-    return np.array(quantized_activations), overflow_flags
+    activations = np.asarray(activations, dtype=np.float64)
+    overflow_flags = np.abs(activations) > quantization_threshold  # outliers
+    # Inliers are truncated towards zero like int(); adding 0.0 turns the -0.0
+    # produced by np.trunc for small negatives into 0.0, as int() would
+    quantized_activations = np.where(overflow_flags, activations, np.trunc(activations) + 0.0)
+
+    return quantized_activations, overflow_flags
 
 # Simulate the PE multiplier group: Inliers are handled with int-fp multipliers, outliers with fp-fp multipliers
 def multiplier_group(quantized_activations, weights, overflow_flags, m, int_max_value=2*31 - 1, int_min_value=-2*31):
@@ -41,11 +54,96 @@ def multiplier_group(quantized_activations, weights, overflow_flags, m, int_max_
     
     return result
 
+# Batched PE multiplier group: all (patch, output channel) dot products at once
+def multiplier_group_batched(quantized_patches, weight_matrix, overflow_mask, m, int_max_value=2*31 - 1, int_min_value=-2*31):
+    """
+    Batched version of multiplier_group. Row p of quantized_patches/overflow_mask is
+    one flattened activation tile and row c of weight_matrix is the flattened kernel
+    of output channel c. Returns a (patches x Cout) array of dot products.
+    """
+    # Running outlier count along each patch: the first m outliers of a patch are
+    # handled by the fp-fp multipliers, every later one saturates to INT_MAX/INT_MIN
+    outlier_rank = np.cumsum(overflow_mask, axis=1)
+    saturated = overflow_mask & (outlier_rank > m)
+    saturated_values = np.where(quantized_patches > 0, int_max_value, int_min_value)
+
+    # Inliers (int-fp) and in-capacity outliers (fp-fp) use the activation itself
+    effective_activations = np.where(saturated, saturated_values, quantized_patches)
+
+    return effective_activations @ weight_matrix.T
+
+# Zero-copy tile extraction for the PE array
+def im2col_view(activations, Kh, Kw):
+    """
+    Return every Kh x Kw tile of an (N, H, W, Cin) tensor as a strided view of
+    shape (N, H, W, Kh, Kw, Cin), one tile per output spatial location. The input
+    is zero-padded at the bottom/right so the edge tiles have the full kernel size.
+    Reshaping the view to (N*H*W, Kh*Kw*Cin) gives the im2col matrix whose columns
+    line up with weight_vector.reshape(Cout, Kh*Kw*Cin).
+    """
+    padded = np.pad(activations, ((0, 0), (0, Kh - 1), (0, Kw - 1), (0, 0)))
+    windows = sliding_window_view(padded, (Kh, Kw), axis=(1, 2))  # (N, H, W, Cin, Kh, Kw)
+    return windows.transpose(0, 1, 2, 4, 5, 3)
+
+# PE array size the tile iteration counts are modelled for (128x128 PEs)
+REFERENCE_PE_ARRAY_SIZE = 128 * 128
+
+# Closed-form iteration and memory-access counters of compute_conv2d_pe
+def conv2d_pe_counters(N, Hout, Wout, Cin, Cout, Kh, Kw, iterations_per_tile=2, PE_array_size=REFERENCE_PE_ARRAY_SIZE, memory=None):
+    """
+    Return the counters of compute_conv2d_pe for the given layer shape without
+    running the loop nest or touching any tensor data. compute_cycles scales the
+    tile iterations by the throughput of a PE_array_size array relative to the
+    reference 128x128 array. The layer is mapped as an (N*Hout*Wout x Kh*Kw*Cin)
+    x (Kh*Kw*Cin x Cout) GEMM onto the memory hierarchy, in folds of the array's
+    rows and columns. The activation and weight memory accesses are its ifmap
+    and filter SRAM reads; its DRAM traffic goes through the roofline model, which
+    adds the stall cycles, the achieved bandwidth and the bound regime;
+    total_cycles includes the stalls.
+    """
+    memory = DEFAULT_MEMORY if memory is None else memory
+    num_locations = N * Hout * Wout
+    # Activations in all tiles (edge tiles are zero-padded to the full kernel size)
+    tile_elements = num_locations * Kh * Kw * Cin
+    total_tile_iterations = num_locations * Cout * iterations_per_tile
+    compute_cycles = -(-total_tile_iterations * REFERENCE_PE_ARRAY_SIZE // PE_array_size)
+
+    # The input is stored once and expanded into Kh x Kw tiles on its way into the array
+    array_dim = math.isqrt(PE_array_size)
+    accesses = memory.gemm_accesses(num_locations, Kh * Kw * Cin, Cout, array_dim, array_dim,
+                                    ifmap_duplication=Kh * Kw)
+    layer_roofline = roofline(compute_cycles, memory.dram_bytes(accesses), MEMORY_BANDWIDTH_BPS, CLOCK_SPEED_GHZ)
+
+    return {
+        "compute_cycles": compute_cycles,
+        "total_cycles": layer_roofline["total_cycles"],
+        "memory_cycles": layer_roofline["memory_cycles"],
+        "stall_cycles": layer_roofline["stall_cycles"],
+        "achieved_bandwidth_bps": layer_roofline["achieved_bandwidth_bps"],
+        "bound": layer_roofline["bound"],
+        "ifmap_sram_reads": accesses["ifmap_sram_reads"],
+        "filter_sram_reads": accesses["filter_sram_reads"],
+        "ofmap_sram_writes": accesses["ofmap_sram_writes"],
+        "ifmap_dram_reads": accesses["ifmap_dram_reads"],
+        "filter_dram_reads": accesses["filter_dram_reads"],
+        "ofmap_dram_writes": accesses["ofmap_dram_writes"],
+        "total_main_iterations": num_locations,
+        "total_output_channel_iterations": num_locations * Cout,
+        "total_quantization_operations": tile_elements * Cout,
+        "total_multiplier_operations": tile_elements * Cout * iterations_per_tile,
+        "total_tile_iterations": total_tile_iterations,
+        "activation_memory_accesses": accesses["ifmap_sram_reads"],
+        "weight_memory_accesses": accesses["filter_sram_reads"],
+    }
+
 # Simulate the 2D Convolution with a PE array
-def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantization_threshold=0.5, m=1, iterations_per_tile=2):
+def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantization_threshold=0.5, m=1, iterations_per_tile=2, count_only=False, verbose=True, PE_array_size=REFERENCE_PE_ARRAY_SIZE):
     """
     Simulates the 2D convolution with a PE group, quantization, overflow detection,
     and handling of inliers and outliers in the multiplier group.
+
+    With count_only=True only the tensor shapes are used: the counters are computed
+    in closed form and returned as a dict instead of the convolution output.
     """
     N, Hout, Wout, Cin = input_activations.shape  # Here, input_activations should be a 4D array
     Cout, Kh, Kw, Cin_weight = weight_vector.shape  # Correct unpacking for 4D weight vector
@@ -54,73 +152,138 @@ def compute_conv2d_pe(input_activations, weight_vector, kernel_size, quantizatio
     if Cin != Cin_weight:
         raise ValueError(f"Input channels ({Cin}) and weight channels ({Cin_weight}) must match.")
     
-    output = np.zeros((Hout, Wout, Cout))  # Output with Cout channels
-    
-    # Initialize counters
-    total_main_iterations = 0
-    total_output_channel_iterations = 0
-    total_quantization_operations = 0
-    total_multiplier_operations = 0
-    total_tile_iterations = 0
-
-    #Memory access
-    activation_memory_accesses = 0
-    weight_memory_accesses = 0
-    
-    # 128x128 PE array (assuming it can handle 128x128 multiplications simultaneously)
-    PE_array_size = 128 * 128  # 128x128 array of Processing Elements
-    
-    for d1 in range(N * Hout * Wout):  # Loop over all output spatial locations
-        total_main_iterations += 1  # Count main loop iterations
-        
-        batch_idx = d1 // (Hout * Wout)
-        spatial_idx = d1 % (Hout * Wout)
-        out_h = spatial_idx // Wout
-        out_w = spatial_idx % Wout
-        
-        # Step 1: Extract the relevant region of the input (this is like reading a tile)
-        input_tile = input_activations[batch_idx, out_h:out_h+Kh, out_w:out_w+Kw, :]
-        ######
-        activation_memory_accesses += 1
-        ######
-
-        # Step 2: For each output channel (d2), compute the dot product of the input and weight vectors
-        for d2 in range(Cout):  # Loop over output channels (Cout)
-            total_output_channel_iterations += 1  # Count output channel iterations
-            
-            # Prepare the weights for the current channel (d2)
-            weights_for_d2 = weight_vector[d2, :, :, :]
-            ########
-            weight_memory_accesses += 1
-            ########
-            # Flatten input tile and weights for dot product calculation
-            flattened_input = input_tile.flatten()
-            flattened_weights = weights_for_d2.flatten()
-            
-            # Step 3: Quantize the activations and detect outliers
-            quantized_activations, overflow_flags = quantize_activations(flattened_input, quantization_threshold)
-            total_quantization_operations += len(flattened_input)  # Count quantization operations
-            
-            # Step 4: Perform the PE computation (dot product) for the current tile
-            for _ in range(iterations_per_tile):
-                total_tile_iterations += 1  # Count iterations per tile
-                total_multiplier_operations += len(flattened_input)  # Count multiplier operations
-                multiplier_group(quantized_activations, flattened_weights, overflow_flags, m)
-    
+    # PE_array_size: number of Processing Elements, 128x128 by default
+    # (assuming it can handle 128x128 multiplications simultaneously)
+
+    # Iteration and memory access counters
+    counters = conv2d_pe_counters(N, Hout, Wout, Cin, Cout, Kh, Kw, iterations_per_tile, PE_array_size)
+
+    if not count_only:
+        quantized_input, overflow_mask = quantize_activations(input_activations, quantization_threshold)
+        output = _conv2d_pe_output(quantized_input, overflow_mask, weight_vector, m)
+
     # Print iteration counts
-    #print(f"Total main iterations (over spatial locations): {total_main_iterations}")
-    #print(f"Total output channel iterations: {total_output_channel_iterations}")
-    #print(f"Total quantization operations: {total_quantization_operations}")
-    #print(f"Total multiplier operations: {total_multiplier_operations}")
-    #print(f"Total iterations per tile: {total_tile_iterations}")
-    print(f"Total Cycles: {total_tile_iterations}")
+    if verbose:
+        print_conv2d_pe_counters(counters)
+
+    if count_only:
+        return counters
+    return output
+
+# Print the counters reported by compute_conv2d_pe
+def print_conv2d_pe_counters(counters):
+    #print(f"Total main iterations (over spatial locations): {counters['total_main_iterations']}")
+    #print(f"Total output channel iterations: {counters['total_output_channel_iterations']}")
+    #print(f"Total quantization operations: {counters['total_quantization_operations']}")
+    #print(f"Total multiplier operations: {counters['total_multiplier_operations']}")
+    #print(f"Total iterations per tile: {counters['total_tile_iterations']}")
+    print(f"Total Cycles: {counters['total_cycles']}")
 
     ########
-    print(f"Activation memory accesses: {activation_memory_accesses}")
-    print(f"Weight memory accesses: {weight_memory_accesses}")
+    print(f"Activation memory accesses (ifmap SRAM reads): {counters['activation_memory_accesses']}")
+    print(f"Weight memory accesses (filter SRAM reads): {counters['weight_memory_accesses']}")
     ########
-    
-    return output
+    print(f"DRAM accesses: {counters['ifmap_dram_reads']} ifmap, {counters['filter_dram_reads']} filter, "
+          f"{counters['ofmap_dram_writes']} ofmap")
+    print(f"Stall Cycles: {counters['stall_cycles']} ({counters['bound']}-bound, "
+          f"achieved bandwidth {counters['achieved_bandwidth_bps'] / 1e12:.3f} TB/s)")
+
+# Functional part of compute_conv2d_pe: the PE dot products on a quantized input.
+# The whole input tensor is quantized once up front; every output channel reuses it.
+def _conv2d_pe_output(quantized_input, overflow_mask, weight_vector, m):
+    N, Hout, Wout, Cin = quantized_input.shape
+    Cout, Kh, Kw, _ = weight_vector.shape
+
+    # One row per output spatial location holding its flattened tile
+    patch_size = Kh * Kw * Cin
+    quantized_patches = im2col_view(quantized_input, Kh, Kw).reshape(-1, patch_size)
+    overflow_patches = im2col_view(overflow_mask, Kh, Kw).reshape(-1, patch_size)
+
+    # Perform the PE computation for all (location, channel) pairs at once
+    weight_matrix = weight_vector.reshape(Cout, patch_size)
+    results = multiplier_group_batched(quantized_patches, weight_matrix, overflow_patches, m)
+    return results.reshape(N, Hout, Wout, Cout)  # Output with Cout channels
+
+# Simulate the 2D Convolution over consecutive diffusion timesteps (differential computing)
+def compute_conv2d_pe_differential(activation_sequence, weight_vector, kernel_size, quantization_threshold=0.5, m=1, iterations_per_tile=2, inlier_bits=3, outlier_bits=16):
+    """
+    Run the PE-array convolution over a sequence of activation tensors, one per
+    diffusion timestep. Each step quantizes only the delta against the cached
+    input of the previous step, feeds the delta through the inlier/outlier
+    multiplier path and adds the result to the cached output of the previous step.
+    The first step is the delta against an all-zero state, i.e. a full computation.
+
+    The cache holds the input the cached output was computed from (the previous
+    cached input plus the quantized delta), not the exact previous input, so the
+    part of a delta that quantizes away is carried into the next step's delta
+    instead of being lost. Outliers past the m fp-fp multipliers of a tile still
+    saturate in the output, as in compute_conv2d_pe.
+
+    Yields (output, step_report) per timestep. Only tiles with a nonzero quantized
+    delta are computed: step_report holds their number, the compute cycles scaled
+    by it and the total cycles of the roofline model on the delta stream (inliers
+    as low-bit integers, outliers as an (index, full-precision value) stream), the
+    filter reads and the read-modify-write of the updated outputs. The DRAM bytes
+    of each operand and the memory cycles the roofline charged for them are
+    reported alongside.
+    """
+    Cout, Kh, Kw, Cin_weight = weight_vector.shape
+
+    previous_input = None
+    previous_output = None
+
+    for step, input_activations in enumerate(activation_sequence):
+        N, Hout, Wout, Cin = input_activations.shape
+        if Cin != Cin_weight:
+            raise ValueError(f"Input channels ({Cin}) and weight channels ({Cin_weight}) must match.")
+
+        if previous_input is None:  # Cold start: nothing cached yet
+            previous_input = np.zeros_like(input_activations, dtype=np.float64)
+            previous_output = np.zeros((N, Hout, Wout, Cout))
+
+        # Quantize the delta against the cached previous step
+        delta = input_activations - previous_input
+        quantized_delta, overflow_mask = quantize_activations(delta, quantization_threshold)
+
+        # Only the delta goes through the multiplier groups; the output is updated incrementally
+        output = previous_output + _conv2d_pe_output(quantized_delta, overflow_mask, weight_vector, m)
+
+        # Tiles whose quantized delta is all zero leave their outputs unchanged and are skipped
+        num_locations = N * Hout * Wout
+        active_tiles = int(np.count_nonzero(
+            im2col_view(quantized_delta != 0, Kh, Kw).reshape(num_locations, -1).any(axis=1)))
+        counters = conv2d_pe_counters(N, Hout, Wout, Cin, Cout, Kh, Kw, iterations_per_tile)
+        compute_cycles = -(-counters["compute_cycles"] * active_tiles // num_locations)
+
+        # Memory traffic of this step: inliers travel as low-bit integers,
+        # outliers as a compressed (index, full-precision value) stream
+        outliers = int(np.count_nonzero(overflow_mask))
+        inliers = delta.size - outliers
+        index_bits = max(1, int(np.ceil(np.log2(delta.size))))
+        activation_bytes = (inliers * inlier_bits + outliers * (index_bits + outlier_bits) + 7) // 8
+        operand_bytes = {
+            "ifmap": activation_bytes,
+            "filter": DEFAULT_MEMORY.dram_bytes(counters)["filter"] if active_tiles else 0,
+            "ofmap": 2 * active_tiles * Cout * DEFAULT_MEMORY.word_bytes,
+        }
+        step_roofline = roofline(compute_cycles, operand_bytes, MEMORY_BANDWIDTH_BPS, CLOCK_SPEED_GHZ)
+        step_report = {
+            "step": step,
+            "active_tiles": active_tiles,
+            "compute_cycles": compute_cycles,
+            "total_cycles": step_roofline["total_cycles"],
+            "memory_cycles": step_roofline["memory_cycles"],
+            "stall_cycles": step_roofline["stall_cycles"],
+            "inliers": inliers,
+            "outliers": outliers,
+            "activation_bytes": activation_bytes,
+            "filter_bytes": operand_bytes["filter"],
+            "ofmap_bytes": operand_bytes["ofmap"],
+        }
+
+        previous_input = previous_input + quantized_delta
+        previous_output = output
+        yield output, step_report
 
 # Define GUID 128 and GUID 512 parameters
 models = {
@@ -138,18 +301,35 @@ Cin = 3  # Input channels
 Kh, Kw = 3, 3  # Kernel size
 quantization_threshold = 0.5  # Threshold for outlier detection
 m = 1  # Number of outliers that can be handled with fp-fp multipliers
+timesteps = 4  # Diffusion timesteps for the differential run
+delta_scale = 0.05  # Standard deviation of the activation change between timesteps
 
-# Iterate through models
-for model_name, params in models.items():
-    Hout, Wout, Cout = params["Hout"], params["Wout"], params["Cout"]
+if __name__ == "__main__":
+    # Iterate through models
+    for model_name, params in models.items():
+        Hout, Wout, Cout = params["Hout"], params["Wout"], params["Cout"]
     
-    # Generate input activations and weights
-    input_activations = np.random.rand(N, Hout, Wout, Cin)  # Random activations
-    weight_vector = np.random.rand(Cout, Kh, Kw, Cin)  # Random weights
+        # Generate input activations and weights
+        input_activations = np.random.rand(N, Hout, Wout, Cin)  # Random activations
+        weight_vector = np.random.rand(Cout, Kh, Kw, Cin)  # Random weights
     
-    # Run the computation
-    print(f"\nRunning convolution for {model_name}...")
-    output = compute_conv2d_pe(input_activations, weight_vector, (Kh, Kw), quantization_threshold, m)
+        # Run the computation
+        print(f"\nRunning convolution for {model_name}...")
+        output = compute_conv2d_pe(input_activations, weight_vector, (Kh, Kw), quantization_threshold, m)
+
+        # Differential run over a few diffusion timesteps with small changes between steps
+        activation_sequence = [input_activations]
+        for _ in range(timesteps - 1):
+            activation_sequence.append(activation_sequence[-1] + np.random.normal(0, delta_scale, input_activations.shape))
+
+        print(f"\nRunning differential convolution for {model_name} over {timesteps} timesteps...")
+        for _, step_report in compute_conv2d_pe_differential(activation_sequence, weight_vector, (Kh, Kw), quantization_threshold, m):
+            print(f"Step {step_report['step']}: Total Cycles: {step_report['total_cycles']} "
+                  f"({step_report['active_tiles']} active tiles), "
+                  f"Memory bytes: {step_report['activation_bytes']} activation, "
+                  f"{step_report['filter_bytes']} filter, {step_report['ofmap_bytes']} ofmap "
+                  f"({step_report['memory_cycles']} memory cycles), "
+                  f"Outliers: {step_report['outliers']}")
 
 
 
@@ -0,0 +1,177 @@
+#Design-space exploration with Pareto pruning
+import itertools
+import math
+
+import numpy as np
+
+import baseline
+import cambriconD
+
+# Objectives of every design point, all minimized (memory accesses are DRAM accesses)
+OBJECTIVES = ("total_cycles", "memory_accesses", "multipliers")
+
+# Layer shapes explored for each GUID model; the baseline runs the same layer as its im2col GEMM
+DSE_LAYERS = {
+    "GUID 128": {"N": 1, "Hout": 64, "Wout": 64, "Cin": 3, "Cout": 128, "Kh": 3, "Kw": 3},
+    "GUID 512": {"N": 1, "Hout": 128, "Wout": 128, "Cin": 3, "Cout": 512, "Kh": 3, "Kw": 3},
+}
+
+# Default parameter ranges
+DSE_RANGES = {
+    "m": [1, 2, 4, 8],
+    "quantization_threshold": [0.25, 0.5, 0.75],
+    "iterations_per_tile": [1, 2, 4],
+    "PE_array_size": [64 * 64, 128 * 128, 256 * 256],
+    "array_dim": [64, 128, 256, 512],
+}
+
+
+def dominates(a, b):
+    """
+    True if objective vector a is at least as good as b everywhere and strictly
+    better somewhere.
+    """
+    return all(x <= y for x, y in zip(a, b)) and any(x < y for x, y in zip(a, b))
+
+
+def _covered(a, b):
+    """
+    True if objective vector a is at least as good as b everywhere (weak dominance).
+    """
+    return all(x <= y for x, y in zip(a, b))
+
+
+def cambriconD_multipliers(PE_array_size, m):
+    """
+    Multiplier count of a Cambricon-D PE array: one int-fp multiplier per PE plus
+    m fp-fp outlier multipliers shared by each PE row.
+    """
+    return PE_array_size + math.isqrt(PE_array_size) * m
+
+
+def _cambriconD_point(layer, m, quantization_threshold, iterations_per_tile, PE_array_size):
+    counters = cambriconD.conv2d_pe_counters(layer["N"], layer["Hout"], layer["Wout"], layer["Cin"], layer["Cout"],
+                                             layer["Kh"], layer["Kw"], iterations_per_tile, PE_array_size)
+    params = {
+        "m": m,
+        "quantization_threshold": quantization_threshold,
+        "iterations_per_tile": iterations_per_tile,
+        "PE_array_size": PE_array_size,
+    }
+    objectives = (
+        counters["total_cycles"],
+        counters["ifmap_dram_reads"] + counters["filter_dram_reads"] + counters["ofmap_dram_writes"],
+        cambriconD_multipliers(PE_array_size, m),
+    )
+    return params, objectives
+
+
+def _baseline_point(layer, array_dim):
+    # The conv layer as its (N*Hout*Wout x Kh*Kw*Cin) x (Kh*Kw*Cin x Cout) im2col GEMM
+    M = layer["N"] * layer["Hout"] * layer["Wout"]
+    K = layer["Kh"] * layer["Kw"] * layer["Cin"]
+    simulator = baseline.SystolicArraySimulator(array_dim)
+    # Count-only run: zero-strided placeholders carry the matrix shapes
+    ifmap = np.broadcast_to(np.float64(0), (M, K))
+    filter_matrix = np.broadcast_to(np.float64(0), (K, layer["Cout"]))
+    simulator.compute(ifmap, filter_matrix, count_only=True)
+    simulator.memory_access()
+    total_cycles, compute_cycles, memory_access_cycles = simulator.get_results()
+    params = {"array_dim": array_dim}
+    accesses = simulator.memory_accesses
+    objectives = (total_cycles, accesses["ifmap_dram_reads"] + accesses["filter_dram_reads"] + accesses["ofmap_dram_writes"],
+                  simulator.NUM_PES)
+    return params, objectives
+
+
+class _SaturationModel:
+    """
+    Fraction of outliers that exceed the fp-fp capacity m of their tile, measured
+    on sample activations. Per-tile outlier counts are cached per threshold, so
+    each additional m is a cheap reduction.
+    """
+
+    def __init__(self, sample_activations, Kh, Kw):
+        self.sample_activations = sample_activations
+        self.Kh, self.Kw = Kh, Kw
+        self.outliers_per_tile = {}
+
+    def rate(self, quantization_threshold, m):
+        if quantization_threshold not in self.outliers_per_tile:
+            _, overflow_mask = cambriconD.quantize_activations(self.sample_activations, quantization_threshold)
+            tiles = cambriconD.im2col_view(overflow_mask, self.Kh, self.Kw)
+            self.outliers_per_tile[quantization_threshold] = tiles.sum(axis=(3, 4, 5)).ravel()
+        counts = self.outliers_per_tile[quantization_threshold]
+        total = counts.sum()
+        if total == 0:
+            return 0.0
+        return float(np.maximum(counts - m, 0).sum() / total)
+
+
+def explore(layer, ranges=DSE_RANGES, sample_activations=None, max_saturation_rate=None):
+    """
+    Explore the Cambricon-D (m, quantization_threshold, iterations_per_tile,
+    PE_array_size) and baseline (array_dim) parameter ranges for one layer and
+    return the Pareto front of cycles vs. memory accesses vs. multiplier count.
+    Both simulators run the same convolution layer, the baseline as its im2col
+    GEMM, so their points compete on one front.
+
+    Each point's objectives come from the closed-form counters. A point that is
+    already covered by the current front is pruned before its feasibility check;
+    with sample_activations and max_saturation_rate, points whose outlier
+    saturation rate exceeds the limit are rejected. Returns (front, stats).
+    """
+    saturation = None
+    if sample_activations is not None and max_saturation_rate is not None:
+        saturation = _SaturationModel(sample_activations, layer["Kh"], layer["Kw"])
+
+    candidates = itertools.chain(
+        (("cambriconD",) + point for point in itertools.product(
+            ranges["m"], ranges["quantization_threshold"], ranges["iterations_per_tile"], ranges["PE_array_size"])),
+        (("baseline", array_dim) for array_dim in ranges["array_dim"]),
+    )
+
+    front = []
+    stats = {"evaluated": 0, "pruned": 0, "infeasible": 0}
+    for simulator, *values in candidates:
+        stats["evaluated"] += 1
+        if simulator == "cambriconD":
+            params, objectives = _cambriconD_point(layer, *values)
+        else:
+            params, objectives = _baseline_point(layer, *values)
+
+        # Early pruning: skip points the front already covers
+        if any(_covered(point["objectives"], objectives) for point in front):
+            stats["pruned"] += 1
+            continue
+
+        if saturation is not None and simulator == "cambriconD":
+            if saturation.rate(params["quantization_threshold"], params["m"]) > max_saturation_rate:
+                stats["infeasible"] += 1
+                continue
+
+        front = [point for point in front if not dominates(objectives, point["objectives"])]
+        front.append({"simulator": simulator, "params": params, "objectives": objectives})
+
+    front.sort(key=lambda point: point["objectives"])
+    return front, stats
+
+
+def print_front(model_name, front, stats):
+    """
+    Print the Pareto front of one layer.
+    """
+    print(f"\n{model_name} Pareto front ({len(front)} points, {stats['evaluated']} evaluated, "
+          f"{stats['pruned']} pruned, {stats['infeasible']} infeasible):")
+    for point in front:
+        objectives = ", ".join(f"{name}={value}" for name, value in zip(OBJECTIVES, point["objectives"]))
+        params = ", ".join(f"{name}={value}" for name, value in point["params"].items())
+        print(f"  {point['simulator']}: {objectives} ({params})")
+
+
+if __name__ == "__main__":
+    for model_name, layer in DSE_LAYERS.items():
+        # Timestep deltas are mostly small: sample them from a narrow normal distribution
+        sample_activations = np.random.normal(0, 0.25, (layer["N"], layer["Hout"], layer["Wout"], layer["Cin"]))
+        front, stats = explore(layer, sample_activations=sample_activations, max_saturation_rate=0.05)
+        print_front(model_name, front, stats)
@@ -0,0 +1,78 @@
+#On-chip SRAM buffer hierarchy with reuse-aware access counting
+import math
+
+# Loop orders over the folds of a GEMM: "mn" walks the column folds inside each
+# row fold (ifmap block stationary), "nm" the row folds inside each column fold
+# (filter block stationary)
+LOOP_ORDERS = ("mn", "nm")
+
+
+class MemoryHierarchy:
+    """
+    ifmap and filter SRAM buffers with DRAM behind them. For an (M x K) x
+    (K x N) GEMM tiled onto the PE array in folds of tile_m rows and tile_n
+    columns, the SRAM accesses follow from the folds and the DRAM accesses from
+    which blocks stay on chip between the folds that reuse them. The array is
+    output stationary: every fold reduces its full K, so outputs leave the array
+    finished and are written once, with no partial sums to hold or spill.
+    """
+
+    def __init__(self, ifmap_sram_kb=512, filter_sram_kb=512, word_bytes=8, double_buffered=True):
+        self.ifmap_sram_bytes = ifmap_sram_kb * 1024
+        self.filter_sram_bytes = filter_sram_kb * 1024
+        self.word_bytes = word_bytes
+        self.double_buffered = double_buffered  # Half of each buffer is filled while the other half is read
+
+    def _fits(self, elements, sram_bytes):
+        usable_bytes = sram_bytes // 2 if self.double_buffered else sram_bytes
+        return elements * self.word_bytes <= usable_bytes
+
+    def gemm_accesses(self, M, K, N, tile_m, tile_n, loop_order="mn", ifmap_duplication=1):
+        """
+        Element accesses of each operand at each level for one GEMM.
+
+        Every fold streams its tile_m x K ifmap block and K x tile_n filter block
+        out of SRAM once, and every output is written once (output stationary).
+        A block is fetched from DRAM again whenever it does not stay resident until
+        its next use: with "mn" the ifmap block is reused by all column folds of a
+        row fold and the filter by every row fold, with "nm" the other way round.
+        ifmap_duplication is the im2col expansion of a convolution (Kh * Kw): DRAM
+        and the ifmap SRAM hold the raw input, which is expanded as it is read out
+        of SRAM into the array.
+        """
+        if loop_order not in LOOP_ORDERS:
+            raise ValueError(f"Unknown loop order {loop_order!r}, expected one of {LOOP_ORDERS}.")
+
+        row_folds = math.ceil(M / tile_m)
+        col_folds = math.ceil(N / tile_n)
+        ifmap_elements = math.ceil(M * K / ifmap_duplication)
+        ifmap_block = math.ceil(min(tile_m, M) * K / ifmap_duplication)
+        filter_block = K * min(tile_n, N)
+
+        if loop_order == "mn":
+            ifmap_fetches = 1 if self._fits(ifmap_block, self.ifmap_sram_bytes) else col_folds
+            filter_fetches = 1 if self._fits(K * N, self.filter_sram_bytes) else row_folds
+        else:
+            filter_fetches = 1 if self._fits(filter_block, self.filter_sram_bytes) else row_folds
+            ifmap_fetches = 1 if self._fits(ifmap_elements, self.ifmap_sram_bytes) else col_folds
+
+        return {
+            "row_folds": row_folds,
+            "col_folds": col_folds,
+            "ifmap_sram_reads": col_folds * M * K,
+            "filter_sram_reads": row_folds * K * N,
+            "ofmap_sram_writes": M * N,
+            "ifmap_dram_reads": ifmap_fetches * ifmap_elements,
+            "filter_dram_reads": filter_fetches * K * N,
+            "ofmap_dram_writes": M * N,
+        }
+
+    def dram_bytes(self, accesses):
+        """
+        Bytes each operand moves to or from DRAM, for the roofline model.
+        """
+        return {
+            "ifmap": accesses["ifmap_dram_reads"] * self.word_bytes,
+            "filter": accesses["filter_dram_reads"] * self.word_bytes,
+            "ofmap": accesses["ofmap_dram_writes"] * self.word_bytes,
+        }
@@ -0,0 +1,136 @@
+#Persistent simulation-results store keyed by a configuration hash
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# Sources whose content defines the simulator version: any edit to them
+# invalidates the results stored by the previous version
+SIMULATOR_SOURCES = ("cambriconD.py", "baseline.py", "roofline.py", "memory_hierarchy.py", "sweep.py")
+
+# Comparison operators accepted by ResultsStore.query
+_OPERATORS = ("=", "!=", "<", "<=", ">", ">=")
+
+
+def simulator_version(sources=SIMULATOR_SOURCES):
+    """
+    Hash of the simulator source files next to this module.
+    """
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for source in sources:
+        with open(os.path.join(here, source), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def config_hash(simulator, config, seed):
+    """
+    Canonical hash of a simulator configuration and input-generation seed: the
+    same configuration always hashes the same, whatever the key order.
+    """
+    canonical = json.dumps({"simulator": simulator, "config": config, "seed": seed},
+                           sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultsStore:
+    """
+    SQLite database of simulation results. Each run is keyed by config_hash and
+    tagged with the simulator version; runs of other versions are dropped when
+    the store is opened. Every configuration parameter is also stored in an
+    indexed (name, value) table so sweeps can be queried by parameter.
+    """
+
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = simulator_version() if version is None else version
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self._create_tables()
+        self.invalidate()
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    config_hash TEXT PRIMARY KEY,
+                    simulator TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    seed INTEGER,
+                    config TEXT NOT NULL,
+                    results TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS run_params (
+                    config_hash TEXT NOT NULL REFERENCES runs(config_hash) ON DELETE CASCADE,
+                    name TEXT NOT NULL,
+                    value
+                );
+                CREATE INDEX IF NOT EXISTS runs_simulator ON runs(simulator);
+                CREATE INDEX IF NOT EXISTS run_params_name_value ON run_params(name, value);
+                CREATE INDEX IF NOT EXISTS run_params_hash ON run_params(config_hash);
+            """)
+
+    def invalidate(self):
+        """
+        Delete the runs stored by any other simulator version. Returns the number deleted.
+        """
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM runs WHERE version != ?", (self.version,))
+        return cursor.rowcount
+
+    def get(self, simulator, config, seed):
+        """
+        Return the stored results of a configuration, or None if it was never run
+        with the current simulator version.
+        """
+        row = self.connection.execute(
+            "SELECT results FROM runs WHERE config_hash = ? AND version = ?",
+            (config_hash(simulator, config, seed), self.version)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, simulator, config, seed, results):
+        """
+        Store the results of a configuration, replacing any previous entry.
+        """
+        key = config_hash(simulator, config, seed)
+        with self.connection:
+            self.connection.execute("DELETE FROM runs WHERE config_hash = ?", (key,))
+            self.connection.execute(
+                "INSERT INTO runs (config_hash, simulator, version, seed, config, results, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, simulator, self.version, seed, json.dumps(config, sort_keys=True),
+                 json.dumps(results), time.time()))
+            self.connection.executemany(
+                "INSERT INTO run_params (config_hash, name, value) VALUES (?, ?, ?)",
+                [(key, name, value) for name, value in config.items()
+                 if isinstance(value, (int, float, str)) and not isinstance(value, bool)])
+        return key
+
+    def query(self, simulator=None, **conditions):
+        """
+        Return the stored runs whose parameters match every condition. A condition
+        is either a value (equality) or an (operator, value) pair, e.g.
+        query(m=1, Cout=(">=", 256)). Each run is a dict with simulator, seed,
+        config and results.
+        """
+        sql = "SELECT simulator, seed, config, results FROM runs WHERE version = ?"
+        args = [self.version]
+        if simulator is not None:
+            sql += " AND simulator = ?"
+            args.append(simulator)
+        for name, condition in conditions.items():
+            operator, value = condition if isinstance(condition, tuple) else ("=", condition)
+            if operator not in _OPERATORS:
+                raise ValueError(f"Unsupported operator {operator!r} for {name}.")
+            sql += (" AND EXISTS (SELECT 1 FROM run_params p WHERE p.config_hash = runs.config_hash"
+                    f" AND p.name = ? AND p.value {operator} ?)")
+            args += [name, value]
+        sql += " ORDER BY simulator, config"
+        return [{"simulator": row[0], "seed": row[1], "config": json.loads(row[2]), "results": json.loads(row[3])}
+                for row in self.connection.execute(sql, args)]
+
+    def close(self):
+        self.connection.close()
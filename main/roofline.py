@@ -0,0 +1,33 @@
+#Roofline / compute-memory overlap model shared by the baseline and Cambricon-D simulators
+import math
+
+
+def roofline(compute_cycles, operand_bytes, bandwidth_bps, clock_speed_ghz):
+    """
+    Overlap a layer's compute with its off-chip traffic.
+
+    compute_cycles is the cycle count of the compute engine alone and
+    operand_bytes maps each operand (e.g. ifmap, filter, ofmap) to the bytes it
+    moves. Transfers overlap with compute, so the layer takes the longer of the
+    two and the excess memory time shows up as stall cycles. Returns a dict with
+    the memory cycles, stall cycles, total cycles, achieved bandwidth in bytes
+    per second and the bound regime ("compute" or "memory").
+    """
+    clock_hz = clock_speed_ghz * 1e9
+    bytes_moved = sum(operand_bytes.values())
+    bytes_per_cycle = bandwidth_bps / clock_hz
+
+    memory_cycles = math.ceil(bytes_moved / bytes_per_cycle)
+    total_cycles = max(compute_cycles, memory_cycles)
+    stall_cycles = total_cycles - compute_cycles
+
+    return {
+        "operand_bytes": dict(operand_bytes),
+        "bytes_moved": bytes_moved,
+        "compute_cycles": compute_cycles,
+        "memory_cycles": memory_cycles,
+        "stall_cycles": stall_cycles,
+        "total_cycles": total_cycles,
+        "achieved_bandwidth_bps": bytes_moved * clock_hz / total_cycles if total_cycles else 0.0,
+        "bound": "memory" if memory_cycles > compute_cycles else "compute",
+    }
@@ -0,0 +1,268 @@
+#Process-pool sweep runner over the GUID model table
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import baseline
+import cambriconD
+from results_store import ResultsStore
+
+# Seed for the generated input activations, weights and matrices
+SWEEP_SEED = 0
+
+# Results database used by the sweep script
+RESULTS_DB = "results.sqlite3"
+
+# Simulations per model: the Cambricon-D PE array and the baseline systolic array
+SIMULATORS = ("cambriconD", "baseline")
+
+# Baseline systolic array (array_dim, matrix_dim) for each GUID model
+BASELINE_CONFIGS = {
+    "GUID 128": {"array_dim": 128, "matrix_dim": 128},
+    "GUID 512": {"array_dim": 512, "matrix_dim": 512},
+}
+
+
+def _to_shared(array):
+    """
+    Copy an array into a new shared memory block. Returns the block and the
+    (name, shape, dtype) descriptor that workers use to attach to it.
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach(descriptor):
+    """
+    Attach to a shared memory block created by _to_shared. Returns the block
+    (to be closed by the caller) and a read-only array view on it.
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    array.flags.writeable = False
+    return block, array
+
+
+def _run_cambriconD(config, tensors):
+    """
+    Run the Cambricon-D PE-array model on shared input activations and weights.
+    """
+    blocks = []
+    try:
+        block, input_activations = _attach(tensors["input_activations"])
+        blocks.append(block)
+        block, weight_vector = _attach(tensors["weight_vector"])
+        blocks.append(block)
+
+        Kh, Kw = config["Kh"], config["Kw"]
+        output = cambriconD.compute_conv2d_pe(input_activations, weight_vector, (Kh, Kw),
+                                              config["quantization_threshold"], config["m"],
+                                              config["iterations_per_tile"], verbose=False)
+        counters = cambriconD.conv2d_pe_counters(*input_activations.shape, weight_vector.shape[0], Kh, Kw,
+                                                 config["iterations_per_tile"])
+        results = {
+            "total_cycles": counters["total_cycles"],
+            "activation_memory_accesses": counters["activation_memory_accesses"],
+            "weight_memory_accesses": counters["weight_memory_accesses"],
+            "dram_accesses": counters["ifmap_dram_reads"] + counters["filter_dram_reads"] + counters["ofmap_dram_writes"],
+            "stall_cycles": counters["stall_cycles"],
+            "bound": counters["bound"],
+            "output_checksum": float(output.sum()),
+        }
+        del input_activations, weight_vector, output
+        return results
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _run_baseline(config, tensors):
+    """
+    Run the baseline systolic array model on shared ifmap and filter matrices.
+    """
+    blocks = []
+    try:
+        block, ifmap = _attach(tensors["ifmap"])
+        blocks.append(block)
+        block, filter_matrix = _attach(tensors["filter_matrix"])
+        blocks.append(block)
+
+        simulator = baseline.SystolicArraySimulator(config["array_dim"])
+        ofmap = simulator.compute(ifmap, filter_matrix)
+        memory_access_time_ns = simulator.memory_access()
+        total_cycles, compute_cycles, memory_access_cycles = simulator.get_results()
+        results = {
+            "total_cycles": total_cycles,
+            "compute_cycles": compute_cycles,
+            "memory_access_cycles": memory_access_cycles,
+            "memory_access_time_ns": memory_access_time_ns,
+            "dram_accesses": (simulator.memory_accesses["ifmap_dram_reads"] + simulator.memory_accesses["filter_dram_reads"]
+                              + simulator.memory_accesses["ofmap_dram_writes"]),
+            "stall_cycles": simulator.stall_cycles,
+            "bound": simulator.roofline["bound"],
+            "output_checksum": float(ofmap.sum()),
+        }
+        del ifmap, filter_matrix, ofmap
+        return results
+    finally:
+        for block in blocks:
+            block.close()
+
+
+_RUNNERS = {
+    "cambriconD": _run_cambriconD,
+    "baseline": _run_baseline,
+}
+
+
+def _run_job(job):
+    """
+    Worker entry point: run one (model, simulator) job.
+    """
+    results = _RUNNERS[job["simulator"]](job["config"], job["tensors"])
+    return job["key"], results
+
+
+def _input_seed(seed, model_index):
+    """
+    Seed of the generated inputs of one model: it depends on the sweep seed and
+    the model's position in the table, and is what the results store is keyed by.
+    """
+    return int(np.random.SeedSequence([seed, model_index]).generate_state(1)[0])
+
+
+def _generate_tensors(input_seed, model_name, params):
+    """
+    Generate the inputs of every simulator for one model from its input seed.
+    The baseline inputs are only generated for models with a baseline config.
+    """
+    rng = np.random.default_rng(input_seed)
+    Hout, Wout, Cout = params["Hout"], params["Wout"], params["Cout"]
+    tensors = {
+        "cambriconD": {
+            "input_activations": rng.random((cambriconD.N, Hout, Wout, cambriconD.Cin)),
+            "weight_vector": rng.random((Cout, cambriconD.Kh, cambriconD.Kw, cambriconD.Cin)),
+        },
+    }
+    if model_name in BASELINE_CONFIGS:
+        matrix_dim = BASELINE_CONFIGS[model_name]["matrix_dim"]
+        tensors["baseline"] = {
+            "ifmap": rng.random((matrix_dim, matrix_dim)),
+            "filter_matrix": rng.random((matrix_dim, matrix_dim)),
+        }
+    return tensors
+
+
+def _job_config(simulator, model_name, params):
+    """
+    Full configuration of one job, including the layer or matrix shape. None
+    for the baseline of a model without an entry in BASELINE_CONFIGS.
+    """
+    if simulator == "cambriconD":
+        return {
+            "N": cambriconD.N,
+            "Hout": params["Hout"],
+            "Wout": params["Wout"],
+            "Cin": cambriconD.Cin,
+            "Cout": params["Cout"],
+            "Kh": cambriconD.Kh,
+            "Kw": cambriconD.Kw,
+            "quantization_threshold": cambriconD.quantization_threshold,
+            "m": cambriconD.m,
+            "iterations_per_tile": 2,
+        }
+    if model_name not in BASELINE_CONFIGS:
+        return None
+    return dict(BASELINE_CONFIGS[model_name])
+
+
+def run_sweep(models=None, simulators=SIMULATORS, seed=SWEEP_SEED, max_workers=None, store=None):
+    """
+    Run every (model, simulator) simulation on a process pool. The generated
+    tensors are placed in shared memory once and the workers attach to them
+    instead of receiving pickled copies. With a ResultsStore, runs already in
+    the store are returned from it and new runs are added to it. Returns the
+    results as a list ordered like the model table and simulators, independent
+    of completion order. Models without a baseline config only run the
+    Cambricon-D simulation.
+    """
+    models = cambriconD.models if models is None else models
+
+    results = {}
+    blocks = []
+    jobs = []
+    try:
+        for model_index, (model_name, params) in enumerate(models.items()):
+            input_seed = _input_seed(seed, model_index)
+            pending = []
+            for simulator in simulators:
+                config = _job_config(simulator, model_name, params)
+                if config is None:
+                    continue
+                cached = store.get(simulator, config, input_seed) if store is not None else None
+                if cached is not None:
+                    results[(model_index, simulator)] = cached
+                else:
+                    pending.append((simulator, config))
+            if not pending:
+                continue
+
+            tensors = _generate_tensors(input_seed, model_name, params)
+            for simulator, config in pending:
+                descriptors = {}
+                for tensor_name, array in tensors[simulator].items():
+                    block, descriptors[tensor_name] = _to_shared(array)
+                    blocks.append(block)
+                jobs.append({
+                    "key": (model_index, simulator),
+                    "simulator": simulator,
+                    "config": config,
+                    "seed": input_seed,
+                    "tensors": descriptors,
+                })
+            del tensors
+
+        if jobs:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for job, (key, job_results) in zip(jobs, executor.map(_run_job, jobs)):
+                    results[key] = job_results
+                    if store is not None:
+                        store.put(job["simulator"], job["config"], job["seed"], job_results)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # Merge in table order so the report does not depend on scheduling
+    model_names = list(models)
+    report = []
+    for model_index, simulator in sorted(results, key=lambda key: (key[0], simulators.index(key[1]))):
+        entry = {"model": model_names[model_index], "simulator": simulator}
+        entry.update(results[(model_index, simulator)])
+        report.append(entry)
+    return report
+
+
+def print_report(report):
+    """
+    Print the merged sweep results, one block per (model, simulator).
+    """
+    for entry in report:
+        print(f"\n{entry['model']} ({entry['simulator']}):")
+        for name, value in entry.items():
+            if name in ("model", "simulator"):
+                continue
+            print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    store = ResultsStore(RESULTS_DB)
+    try:
+        report = run_sweep(max_workers=os.cpu_count(), store=store)
+    finally:
+        store.close()
+    print_report(report)